@@ -0,0 +1,191 @@
+from metaform import __version__
+from metaform.compose import MetaFormer, resolve_dependencies
+from typing import Callable, Optional
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+def _wide(tf: MetaFormer, size: int):
+    for i in range(size):
+        tf.resource("aws_s3_bucket", f"bucket_{i}", bucket=f"bucket-{i}", acl="private")
+
+
+def _deep(tf: MetaFormer, size: int):
+    link = tf.resource("null_resource", "link_0", triggers="start")
+    for i in range(1, size):
+        link = tf.resource("null_resource", f"link_{i}", triggers=link["id"])
+
+
+def _nested(tf: MetaFormer, size: int, depth: int = 4):
+    for i in range(size):
+        nested = tf.property(f"level_{depth}", f"r{i}", value=i, enabled=True)
+        for level in range(depth - 1, 0, -1):
+            nested = tf.property(
+                f"level_{level}", f"r{i}", name=f"r{i}-{level}", child=nested
+            )
+        tf.resource("databricks_job", f"job_{i}", name=f"job-{i}", settings=nested)
+
+
+def _maps(tf: MetaFormer, size: int, width: int = 50):
+    for i in range(size):
+        tags = {f"tag_{t}": f"value-{i}-{t}" for t in range(width)}
+        tf.resource("aws_instance", f"instance_{i}", ami="ami-1234", tags=tags)
+
+
+SCENARIOS = {
+    "wide": (_wide, 100_000),
+    "deep": (_deep, 10_000),
+    "nested": (_nested, 10_000),
+    "maps": (_maps, 10_000),
+}
+
+
+STARTUP_BUDGET = 0.05  # seconds `mf --version` may take over a bare interpreter
+
+
+def measure_startup(runs: int = 5) -> dict[str, float]:
+    """
+    Time a bare interpreter and `mf --version` in fresh processes, keeping the
+    fastest of runs for each, to check the start-up cost of mf against
+    STARTUP_BUDGET
+    """
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [package_dir, env.get("PYTHONPATH")])
+    )
+
+    def fastest(*args: str) -> float:
+        best = float("inf")
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, *args], env=env, check=True, stdout=subprocess.DEVNULL
+            )
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    interpreter = fastest("-c", "pass")
+    mf = fastest(
+        "-c", "import sys; from metaform.cli import main; sys.exit(main())", "--version"
+    )
+    return {
+        "interpreter": interpreter,
+        "mf": mf,
+        "overhead": mf - interpreter,
+        "budget": STARTUP_BUDGET,
+    }
+
+
+def _phases(
+    scenario: Callable[[MetaFormer, int], None], size: int, directory: str
+) -> dict[str, Callable[[], None]]:
+    """
+    Returns the benchmarked phases of a scenario as callables run in order, build
+    clearing the render cache that write filled
+    """
+    tf = MetaFormer(name=os.path.join(directory, "bench"))
+
+    def build():
+        for block in tf.registry.values():
+            block._rendered = None
+        tf.build()
+
+    return {
+        "construct": lambda: scenario(tf, size),
+        "resolve": lambda: resolve_dependencies(tf._collect_dependencies()),
+        "collect": tf.collect,
+        "write": tf._write,
+        "build": build,
+    }
+
+
+def _run_scenario(
+    scenario: Callable[[MetaFormer, int], None], size: int, trace: bool
+) -> dict[str, dict[str, float]]:
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for phase, run in _phases(scenario, size, directory).items():
+            if trace:
+                tracemalloc.start()
+                run()
+                results[phase] = {"peak_bytes": tracemalloc.get_traced_memory()[1]}
+                tracemalloc.stop()
+            else:
+                start = time.perf_counter()
+                run()
+                results[phase] = {"seconds": time.perf_counter() - start}
+    return results
+
+
+def run_benchmarks(
+    scale: float = 1.0,
+    scenarios: Optional[list[str]] = None,
+    memory: bool = True,
+) -> dict:
+    """
+    Time each phase of every scenario, then rerun it under tracemalloc to record
+    the peak memory of each phase without skewing the timings
+    """
+    results = {
+        "metaform": __version__,
+        "python": platform.python_version(),
+        "scale": scale,
+        "scenarios": {},
+    }
+    results["startup"] = measure_startup()
+    for name in scenarios or SCENARIOS:
+        scenario, size = SCENARIOS[name]
+        size = max(int(size * scale), 1)
+        phases = _run_scenario(scenario, size, trace=False)
+        if memory:
+            for phase, traced in _run_scenario(scenario, size, trace=True).items():
+                phases[phase].update(traced)
+        results["scenarios"][name] = {"size": size, "phases": phases}
+    return results
+
+
+def format_results(results: dict, baseline: Optional[dict] = None) -> list[str]:
+    """
+    Returns one line per scenario phase, with the ratio to a baseline run if given
+    """
+    lines = []
+    if "startup" in results:
+        startup = results["startup"]
+        lines.append(
+            f"startup: mf --version {startup['mf']:.4f}s, "
+            f"{startup['overhead']:.4f}s over the interpreter "
+            f"({'within' if startup['overhead'] <= startup['budget'] else 'OVER'} "
+            f"the {startup['budget']:.3f}s budget)"
+        )
+    for name, scenario in results["scenarios"].items():
+        lines.append(f"{name} (size {scenario['size']})")
+        base = (baseline or {}).get("scenarios", {}).get(name, {}).get("phases", {})
+        for phase, measured in scenario["phases"].items():
+            line = f"  {phase:<10}{measured['seconds']:>10.4f}s"
+            if "peak_bytes" in measured:
+                line += f"{measured['peak_bytes'] / 2**20:>10.1f} MiB"
+            if base.get(phase, {}).get("seconds"):
+                line += f"{measured['seconds'] / base[phase]['seconds']:>8.2f}x"
+            lines.append(line)
+    return lines
+
+
+def main(args) -> int:
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+    results = run_benchmarks(args.scale, args.scenario, memory=not args.no_memory)
+    for line in format_results(results, baseline):
+        print(line)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    return 0
@@ -1,5 +1,8 @@
 from __future__ import annotations
 from typing import Any, Union, Optional
+import re
+import sys
+import weakref
 
 
 _VARIABLE = "variable"
@@ -20,6 +23,9 @@ _GROUP_VALENCE = {
     _OUTPUT: 1,
     _PROVIDER: 1,
 }
+_DEPENDENCY_GROUPS = frozenset((_VARIABLE, _DATA, _MODULE, _RESOURCE, _OUTPUT))
+_NO_DEPENDENCIES = frozenset()  # shared by blocks without dependencies
+_PLAIN_VALUES = frozenset((str, int, float, bool, type(None)))  # never dependencies
 
 
 class BlockError(Exception):
@@ -28,21 +34,192 @@ class BlockError(Exception):
     """
 
 
+class DependencyError(Exception):
+    """
+    Exception to return due to issues resolving dependencies
+    """
+
+
 class Caller:
+    __slots__ = ("base", "call", "_key")
+
     def __init__(self, base: Any, call: str):
         self.base = base
         self.call = call
+        self._key = f"{str(self.base)}.{self.call}"
 
     def __str__(self) -> str:
-        return f"{str(self.base)}.{self.call}"
+        return self._key
 
     def __repr__(self) -> str:
         return self.__str__()
 
 
+class Interpolated:
+    """
+    A string whose ${...} and %{...} template sequences Terraform evaluates, e.g.
+    Interpolated("${var.env}-bucket"), where plain strings are written literally.
+    References in the template are not tracked as dependencies
+    """
+
+    __slots__ = ("template",)
+
+    def __init__(self, template: str):
+        self.template = template
+
+    def __str__(self) -> str:
+        return self.template
+
+    def __repr__(self) -> str:
+        return f"Interpolated({self.template!r})"
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, Interpolated):
+            return self.template == other.template
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash(self.template)
+
+
+_IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_-]*")
+_ESCAPES = str.maketrans(
+    {"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r", "\t": "\\t"}
+)
+
+
+def _escape_template(s: str) -> str:
+    """
+    Escape template sequences so that Terraform reads s literally
+    """
+    return s.replace("${", "$${").replace("%{", "%%{") if "{" in s else s
+
+
+def _quote(s: str) -> str:
+    return '"' + _escape_template(s.translate(_ESCAPES)) + '"'
+
+
+def _map_key(k: str) -> str:
+    return k if _IDENTIFIER.fullmatch(k) else _quote(k)
+
+
+def _heredoc(s: str) -> str:
+    """
+    Render a multi-line string as an indented heredoc, wrapped in chomp when it
+    has no trailing newline since heredocs always end with one
+    """
+    lines = {line.strip() for line in s.split("\n")}
+    delimiter = "EOT"
+    while delimiter in lines:
+        delimiter += "_"
+    if s.endswith("\n"):
+        return f"<<-{delimiter}\n{_escape_template(s)}{delimiter}"
+    return f"chomp(<<-{delimiter}\n{_escape_template(s)}\n{delimiter}\n)"
+
+
+def _string(s: str) -> str:
+    if s.isprintable() and '"' not in s and "\\" not in s and "{" not in s:
+        return f'"{s}"'
+    # <<- strips the indentation shared by all lines, so only use a heredoc
+    # when at least one line is not indented
+    if (
+        "\n" in s
+        and "\r" not in s
+        and any(line and line[0] not in " \t" for line in s.split("\n"))
+    ):
+        return _heredoc(s)
+    return _quote(s)
+
+
+_SERIALIZERS = {
+    str: _string,
+    int: int.__repr__,
+    float: float.__repr__,
+    bool: {True: "true", False: "false"}.__getitem__,
+    type(None): lambda s: "null",
+    Caller: Caller.__str__,
+    Interpolated: lambda s: '"' + s.template.translate(_ESCAPES) + '"',
+}
+
+
+def _serialize(s: Any) -> str:
+    """
+    Serializer for values whose exact type is not in _SERIALIZERS, looked up by
+    its closest base class and cached for the type
+    """
+    for base in type(s).__mro__:
+        if base in _SERIALIZERS:
+            serializer = _SERIALIZERS[base]
+            break
+    else:
+        serializer = lambda s: _quote(str(s))
+    _SERIALIZERS[type(s)] = serializer
+    return serializer(s)
+
+
+class _Properties(dict):
+    """
+    Property dict that invalidates its block's cached rendering when mutated
+    """
+
+    __slots__ = ("_block",)
+
+    def __init__(self, block: Block, properties: dict):
+        super(_Properties, self).__init__(properties)
+        self._block = block
+
+    def __reduce__(self) -> tuple:
+        # copies are detached from the block, so they are plain dicts
+        return dict, (dict(self),)
+
+    def _mutator(name: str):
+        method = getattr(dict, name)
+
+        def mutate(self, *args, **kwargs):
+            previous = dict(self)
+            result = method(self, *args, **kwargs)
+            try:
+                self._block._invalidate()
+            except DependencyError:
+                dict.clear(self)
+                dict.update(self, previous)
+                self._block._invalidate()
+                raise
+            return result
+
+        mutate.__name__ = name
+        return mutate
+
+    __setitem__ = _mutator("__setitem__")
+    __delitem__ = _mutator("__delitem__")
+    __ior__ = _mutator("__ior__")
+    clear = _mutator("clear")
+    pop = _mutator("pop")
+    popitem = _mutator("popitem")
+    setdefault = _mutator("setdefault")
+    update = _mutator("update")
+    del _mutator
+
+
 class Block:
+    __slots__ = (
+        "_group",
+        "group",
+        "group_abbrv",
+        "ids",
+        "_key",
+        "invisible_map",
+        "tomap",
+        "dependencies",
+        "_properties",
+        "_rendered",
+        "_parents",
+        "_registry",
+        "__weakref__",
+    )
     _tab_space = "  "
     _group_abbrv = {_VARIABLE: "var", _MAP: ""}
+    _max_elements = 4
 
     def __init__(
         self,
@@ -52,19 +229,83 @@ class Block:
         invisible_map: bool = False,
         **kwargs: Union[Caller, str, int, float, Block, bool, list, dict],
     ):
-        self._group = _group
-        self.group, self.group_abbrv, self.ids = self._group_id_reprs(
-            _group, args, invisible_map
+        self._group = sys.intern(_group)
+        group, group_abbrv, ids = self._group_id_reprs(
+            _group, tuple(map(str, args)), invisible_map
         )
+        self.group = sys.intern(group)
+        self.group_abbrv = sys.intern(group_abbrv)
+        self.ids = tuple(map(sys.intern, ids))
+        self._key = sys.intern(".".join([self.group_abbrv, *self.ids]).strip("."))
         self.invisible_map = invisible_map
-        self.properties = kwargs
-        self._max_elements = 4
         self.tomap = tomap
-        self.dependencies = set()
-        self._format_props()  # needs to run on start to capture all dependencies
+        self._rendered = None
+        self._parents = None
+        self._registry = None
+        self.properties = kwargs
 
+    @classmethod
+    def _assemble(
+        cls,
+        _group: str,
+        group: str,
+        group_abbrv: str,
+        ids: tuple[str, ...],
+        invisible_map: bool = False,
+        tomap: bool = True,
+    ) -> Block:
+        """
+        Create an empty block from already parsed group and ids, for callers that
+        fill in properties and dependencies they know without rediscovering them
+        """
+        block = cls.__new__(cls)
+        block._group = sys.intern(_group)
+        block.group = sys.intern(group)
+        block.group_abbrv = sys.intern(group_abbrv)
+        block.ids = tuple(map(sys.intern, ids))
+        block._key = sys.intern(".".join([group_abbrv, *ids]).strip("."))
+        block.invisible_map = invisible_map
+        block.tomap = tomap
+        block._rendered = None
+        block._parents = None
+        block._registry = None
+        block._properties = _Properties(block, ())
+        block.dependencies = _NO_DEPENDENCIES
+        return block
+
+    @property
+    def properties(self) -> dict:
+        return self._properties
+
+    @properties.setter
+    def properties(self, properties: dict):
+        previous = getattr(self, "_properties", None)
+        self._properties = _Properties(self, properties)
+        try:
+            self._invalidate()
+        except DependencyError:
+            self._properties = previous
+            self._invalidate()
+            raise
+
+    def _invalidate(self):
+        """
+        Drop the cached rendering of this block and of every block it is nested
+        in, and rediscover dependencies, after its properties change. The registry
+        holding the block rejects dependencies that would close a cycle
+        """
+        self._rendered = None
+        dependencies = self._find_dependencies()
+        if self._registry is not None:
+            self._registry._block_changed(self, dependencies)
+        self.dependencies = dependencies or _NO_DEPENDENCIES
+        if self._parents:
+            for parent in list(self._parents.values()):
+                parent._invalidate()
+
+    @classmethod
     def _group_id_reprs(
-        self, s: str, ids: tuple[str], invisible_map: bool = False
+        cls, s: str, ids: tuple[str], invisible_map: bool = False
     ) -> tuple[str, str, tuple[str]]:
         if s == _MAP:
             if not ids:
@@ -73,23 +314,54 @@ class Block:
                 return ids[0], "", tuple()
         elif s == _PROPERTY:
             return ids[0], ids[0], tuple(ids[1:])
-        return s, self._group_abbrv.get(s, s), ids
+        return s, cls._group_abbrv.get(s, s), ids
 
     def _write_ids(self) -> str:
         return " ".join([self.group] + [f'"{id}"' for id in self.ids]).strip() + " "
 
+    def _lines(self) -> tuple[str, ...]:
+        """
+        Returns the unpadded lines of the block. Blocks nested in others are
+        rendered once and cached until their properties change, so a shared
+        subtree is not rendered again for every parent, while top-level blocks
+        are rendered once per build anyway and keep nothing. Blocks holding maps
+        or lists, which can change in place without invalidating the cache, are
+        rendered every time
+        """
+        if self._rendered is not None:
+            return self._rendered
+        invis_map_insert = "= " if (self.invisible_map) else ""
+        lines = (
+            self._write_ids() + invis_map_insert + "{",
+            *self._format_props(),
+            "}",
+        )
+        if self._parents and self._immutable():
+            self._rendered = lines
+        return lines
+
+    def _immutable(self) -> bool:
+        """
+        Whether the rendered lines only change with the properties of the block
+        or of cached nested blocks
+        """
+        for v in self.properties.values():
+            if isinstance(v, Block):
+                if v._rendered is None:
+                    return False
+            elif isinstance(v, (dict, list, tuple)):
+                return False
+        return True
+
     def _write(self, comment: str = "", pad: int = 0) -> str:
         """
         Creates a string block that translates Block to Terraform
         """
-        invis_map_insert = "= " if (self.invisible_map) else ""
         lines = [f"#{comment}"] if comment else []
-        lines.append(self._write_ids() + invis_map_insert + "{")
-        lines += self._format_props(pad)
-        lines.append("}")
+        lines += self._lines()
         return "\n".join(map(lambda s: pad * self._tab_space + s, lines))
 
-    def _format_props(self, pad: int = 0) -> list[str]:
+    def _format_props(self) -> list[str]:
         """
         Returns a list of parameter lines
         """
@@ -98,64 +370,110 @@ class Block:
             if (self.properties.keys())
             else 0
         )
-        basic_params = []
+        buffer = []
         property_params = []
         for k, v in self.properties.items():
             if isinstance(v, Block):
-                self._add_dependencies(v)
-            elif isinstance(v, Caller):
-                self._add_dependencies(v.base)
-            if isinstance(v, Block):
-                property_params.append(v._write(pad=pad + 1))
+                property_params += [self._tab_space + line for line in v._lines()]
             else:
-                base_string = f"{self._tab_space}{k}{' ' * (max_len - len(k))} = "
-                if isinstance(v, dict):
-                    map_rep = self._map_rep(v)
-                    basic_params.append(base_string + map_rep[0])
-                    basic_params += list(
-                        map(lambda b: len(base_string) * " " + b, map_rep[1:])
-                    )
-                elif isinstance(v, tuple or list):
-                    basic_params.append(
-                        base_string
-                        + "tolist(["
-                        + ",".join(self._parse(_v) for _v in v)
-                        + "])"
-                    )
-                else:
-                    basic_params.append(base_string + self._parse(v))
+                if buffer:
+                    buffer.append("\n")
+                buffer += [self._tab_space, k, " " * (max_len - len(k)), " = "]
+                self._write_value(v, buffer, 1)
+        basic_params = "".join(buffer).split("\n") if buffer else []
         return basic_params + property_params
 
     def __str__(self) -> str:
         return self.__repr__()
 
     def __repr__(self) -> str:
-        return ".".join([self.group_abbrv] + list(self.ids)).strip(".")
-
-    def _parse(self, s: Union[str, int, float, Block, Caller, bool, dict, list]) -> str:
-        if isinstance(s, Caller):
-            return str(s)
-        elif isinstance(s, int or float):
-            return str(s)
-        elif isinstance(s, bool):
-            return str(s).lower()
-        else:
-            return f'"{s}"'
+        return self._key
+
+    def __hash__(self) -> int:
+        return hash(self._key)
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, Block):
+            return self._key == other._key
+        return NotImplemented
+
+    def _parse(self, s: Union[str, int, float, Block, Caller, bool, None]) -> str:
+        return _SERIALIZERS.get(type(s), _serialize)(s)
 
     def __getitem__(self, attribute: str) -> Caller | str:
         return Caller(self, attribute)
 
-    def _map_rep(self, d: dict, pad=0) -> list[str]:
-        dummy_block = Block(_MAP, **d)
-        if self.tomap:
-            base = dummy_block._format_props(pad=pad + 6)
-            base[0] = "tomap(" + base[0]
-            base[-1] = base[-1] + ")"
+    def __reduce__(self) -> tuple:
+        """
+        Pickle and copy blocks as their parsed group and ids with their properties
+        and dependencies as state, restored once the block itself exists so that
+        blocks referring back to it resolve. Copies are not registered
+        """
+        return (
+            type(self)._assemble,
+            (
+                self._group,
+                self.group,
+                self.group_abbrv,
+                self.ids,
+                self.invisible_map,
+                self.tomap,
+            ),
+            (dict(self._properties), self.dependencies),
+        )
+
+    def __setstate__(self, state: tuple[dict, set[Block]]):
+        properties, dependencies = state
+        dict.update(self._properties, properties)
+        self._find_dependencies()  # to track the blocks nested in this one again
+        self.dependencies = dependencies
+
+    def _write_value(self, v: Any, buffer: list[str], depth: int):
+        """
+        Appends the rendering of a property value to buffer in a single pass. Maps
+        and lists of fewer than _max_elements scalars stay on one line, others put
+        each entry on its own line indented one level past depth
+        """
+        if isinstance(v, dict):
+            opening, closing = ("tomap({", "})") if self.tomap else ("{", "}")
+            values = v.values()
+        elif isinstance(v, (list, tuple)):
+            opening, closing = "tolist([", "])"
+            values = v
+        else:
+            rendered = self._parse(v)
+            if "\n" in rendered:  # indent heredocs, <<- strips it again
+                rendered = rendered.replace("\n", "\n" + self._tab_space * depth)
+            buffer.append(rendered)
+            return
+        buffer.append(opening)
+        if len(v) < self._max_elements and not any(
+            isinstance(_v, (dict, list, tuple)) or isinstance(_v, str) and "\n" in _v
+            for _v in values
+        ):
+            if isinstance(v, dict):
+                entries = [f"{_map_key(k)} = {self._parse(_v)}" for k, _v in v.items()]
+                buffer.append(" " + ", ".join(entries) + " " if entries else "")
+            else:
+                buffer.append(", ".join(map(self._parse, v)))
+            buffer.append(closing)
+            return
+        indent = "\n" + self._tab_space * (depth + 1)
+        if isinstance(v, dict):
+            keys = list(map(_map_key, v))
+            max_len = max(map(len, keys))
+            for k, _v in zip(keys, values):
+                buffer += [indent, k, " " * (max_len - len(k)), " = "]
+                self._write_value(_v, buffer, depth + 1)
         else:
-            base = dummy_block._format_props(pad=pad)
-        if len(base) < self._max_elements:
-            base = [base[0] + ",".join(base[1:-1]) + base[-1]]
-        return base
+            for _v in v:
+                buffer.append(indent)
+                if isinstance(_v, str):
+                    buffer.append(_quote(_v))  # a heredoc cannot precede the comma
+                else:
+                    self._write_value(_v, buffer, depth + 1)
+                buffer.append(",")
+        buffer += ["\n", self._tab_space * depth, closing]
 
     def _validate(self):
         # TODO: Validate new blocks exist and have all required properties
@@ -165,7 +483,34 @@ class Block:
                 f'Group "{self._group}" requires valence {group_valence}, but got {len(self.ids)}.'
             )
 
-    def _add_dependencies(self, v: Block):
-        for sub in [v] + list(v.dependencies):
-            if sub._group in [_VARIABLE, _DATA, _MODULE, _RESOURCE, _OUTPUT]:
-                self.dependencies.add(v)
+    def _find_dependencies(self) -> set[Block]:
+        """
+        Walks the property values (including nested dicts, lists and tuples) and
+        returns the blocks this block depends on without rendering anything
+        """
+        dependencies = set()
+        stack = list(self.properties.values())
+        while stack:
+            v = stack.pop()
+            if isinstance(v, Block):
+                v._add_parent(self)
+            while isinstance(v, Caller):
+                v = v.base
+            if isinstance(v, Block):
+                if v._group in _DEPENDENCY_GROUPS:
+                    dependencies.add(v)
+                else:
+                    dependencies.update(v.dependencies)
+            elif isinstance(v, dict):
+                stack.extend(v.values())
+            elif isinstance(v, (list, tuple)):
+                stack.extend(v)
+        return dependencies
+
+    def _add_parent(self, parent: Block):
+        """
+        Track blocks that embed this one so they can be invalidated with it
+        """
+        if self._parents is None:
+            self._parents = weakref.WeakValueDictionary()
+        self._parents[id(parent)] = parent
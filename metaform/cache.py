@@ -0,0 +1,128 @@
+from metaform import __version__
+from types import CodeType
+from typing import Optional
+import json
+import marshal
+import os
+import sys
+
+
+CACHE_FILE = ".metaform-cache"
+SCRIPT_CACHE_DIR = "__pycache__"
+_CODE_MAGIC = b"MFCODE1\n"
+
+
+def file_hash(path: str) -> str:
+    import hashlib  # only needed once a file's stat changed
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_stat(path: str) -> Optional[list[int]]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def script_cache_path(path: str) -> str:
+    directory, name = os.path.split(path)
+    return os.path.join(
+        directory, SCRIPT_CACHE_DIR, f"{name}.{sys.implementation.cache_tag}.mfc"
+    )
+
+
+def compile_script(path: str) -> CodeType:
+    """
+    Returns the code object of a metaform script, cached in __pycache__ next to
+    it and reused while the script's mtime and size and the Python version
+    match the ones it was compiled for
+    """
+    stat = os.stat(path)
+    key = (sys.version, stat.st_mtime_ns, stat.st_size)
+    cache_path = script_cache_path(path)
+    try:
+        with open(cache_path, "rb") as f:
+            if f.read(len(_CODE_MAGIC)) == _CODE_MAGIC:
+                *cached_key, code = marshal.load(f)
+                if tuple(cached_key) == key:
+                    return code
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    with open(path, "rb") as f:
+        code = compile(f.read(), path, "exec", dont_inherit=True)
+    if not sys.dont_write_bytecode:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(_CODE_MAGIC)
+                marshal.dump((*key, code), f)
+            os.replace(tmp_path, cache_path)
+        except OSError:  # like bytecode, the cache is skipped where it is read-only
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+    return code
+
+
+def _file_record(path: str) -> dict:
+    return {"hash": file_hash(path), "stat": file_stat(path)}
+
+
+class BuildCache:
+    """
+    Manifest of script and output hashes used by mf to skip unchanged scripts
+    """
+
+    def __init__(self, root_dir: str = "."):
+        self.path = os.path.join(root_dir, CACHE_FILE)
+        self.scripts = {}
+        try:
+            with open(self.path, "r") as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        if manifest.get("version") == __version__:
+            self.scripts = manifest.get("scripts", {})
+
+    def _unchanged(self, path: str, record: dict) -> bool:
+        """
+        Compare a file against its record, only hashing it when its stat changed
+        """
+        stat = file_stat(path)
+        if stat is None:
+            return False
+        if stat == record["stat"]:
+            return True
+        if file_hash(path) != record["hash"]:
+            return False
+        record["stat"] = stat
+        return True
+
+    def is_fresh(self, script: str) -> bool:
+        entry = self.scripts.get(script)
+        if entry is None or not self._unchanged(script, entry):
+            return False
+        return all(
+            self._unchanged(path, record) for path, record in entry["outputs"].items()
+        )
+
+    def outputs(self, script: str) -> tuple[str, ...]:
+        return tuple(self.scripts.get(script, {}).get("outputs", ()))
+
+    def update(self, script: str, ok: bool, outputs: tuple[str, ...]):
+        if not ok:
+            self.scripts.pop(script, None)
+            return
+        entry = _file_record(script)
+        entry["outputs"] = {path: _file_record(path) for path in outputs}
+        self.scripts[script] = entry
+
+    def save(self):
+        with open(self.path, "w") as f:
+            json.dump({"version": __version__, "scripts": self.scripts}, f, indent=1)
@@ -1,20 +1,275 @@
 from argparse import ArgumentParser
-from pathlib import Path
+from metaform import __version__
+from typing import TYPE_CHECKING, Iterator, NamedTuple, Optional
+import io
+import time
 
+if TYPE_CHECKING:
+    from metaform.cache import BuildCache
 
-def find_and_generate_metaf_files(root_dir: str = "."):
-    for files in Path(root_dir).rglob("*.tf.py"):
-        print(f"In file {files}")
-        with open(files, "r") as f:
-            exec(f.read())
+# Everything else is imported where it is used, so that `mf --version` and runs
+# over cached scripts cost little more than starting the interpreter. The
+# startup benchmark of `mf bench` checks this against STARTUP_BUDGET
 
 
-def main():
+class ScriptResult(NamedTuple):
+    path: str
+    ok: bool
+    seconds: float
+    output: str
+    outputs: tuple[str, ...] = ()
+    cached: bool = False
+    stats: tuple[dict, ...] = ()
+
+
+def run_metaf_file(
+    path: str, stats: bool = False, graph: Optional[str] = None
+) -> ScriptResult:
+    """
+    Execute a single metaform script in a fresh namespace, capturing its output
+    and, with stats, the BuildStats of every build it runs. With graph ("dot" or
+    "json") every build also writes its dependency graph next to its output
+    """
+    from metaform.cache import compile_script
+    from metaform.compose import build_session
+    from contextlib import redirect_stdout
+    import traceback
+
+    output = io.StringIO()
+    start = time.perf_counter()
+    ok = True
+    with redirect_stdout(output), build_session(stats, graph) as session:
+        try:
+            code = compile_script(path)
+            exec(code, {"__name__": "__main__", "__file__": path})
+        except SystemExit as error:
+            if error.code not in (0, None):  # sys.exit() with a status is a failure
+                ok = False
+                output.write(traceback.format_exc())
+        except Exception:
+            ok = False
+            output.write(traceback.format_exc())
+    seconds = time.perf_counter() - start
+    return ScriptResult(
+        path,
+        ok,
+        seconds,
+        output.getvalue(),
+        tuple(session.paths),
+        stats=tuple(
+            result.stats.as_dict()
+            for result in session.results
+            if result.stats is not None
+        ),
+    )
+
+
+def find_metaf_files(root_dir: str = ".") -> dict[str, int]:
+    """
+    Map every metaform script under root_dir to its modification time
+    """
+    from pathlib import Path
+
+    return {
+        str(path): path.stat().st_mtime_ns for path in Path(root_dir).rglob("*.tf.py")
+    }
+
+
+def find_and_generate_metaf_files(
+    root_dir: str = ".",
+    jobs: int = 1,
+    force: bool = False,
+    paths: Optional[list[str]] = None,
+    stats: bool = False,
+    graph: Optional[str] = None,
+) -> list[ScriptResult]:
+    from metaform.cache import BuildCache
+    from functools import partial
+
+    run = partial(run_metaf_file, stats=stats, graph=graph)
+    if paths is None:
+        paths = find_metaf_files(root_dir)
+    paths = sorted(paths)
+    cache = BuildCache(root_dir)
+    stale = [
+        path
+        for path in paths
+        if force or not cache.is_fresh(path) or not _has_graphs(cache, path, graph)
+    ]
+    if jobs > 1 and len(stale) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            runs = pool.map(run, stale)
+            results = _merge_results(paths, set(stale), runs, cache)
+    else:
+        runs = map(run, stale)
+        results = _merge_results(paths, set(stale), runs, cache)
+    cache.save()
+    return results
+
+
+def _has_graphs(cache: "BuildCache", script: str, graph: Optional[str]) -> bool:
+    """
+    Whether the cached outputs of a script include the graphs asked for
+    """
+    return graph is None or any(
+        path.endswith(f".graph.{graph}") for path in cache.outputs(script)
+    )
+
+
+def _merge_results(
+    paths: list[str],
+    stale: set[str],
+    runs: Iterator[ScriptResult],
+    cache: "BuildCache",
+) -> list[ScriptResult]:
+    """
+    Interleave fresh runs with cached scripts, reporting each in path order
+    """
+    results = []
+    for path in paths:
+        if path in stale:
+            result = next(runs)
+            cache.update(path, result.ok, result.outputs)
+        else:
+            result = ScriptResult(path, True, 0.0, "", cache.outputs(path), True)
+        results.append(_report(result))
+    return results
+
+
+def watch_metaf_files(
+    root_dir: str = ".",
+    jobs: int = 1,
+    interval: float = 0.5,
+    debounce: float = 0.2,
+    max_cycles: Optional[int] = None,
+    stats: bool = False,
+    graph: Optional[str] = None,
+):
+    """
+    Poll script modification times and regenerate only the scripts that changed,
+    waiting until a burst of changes has settled for `debounce` seconds
+    """
+    mtimes = find_metaf_files(root_dir)
+    cycles = 0
+    while max_cycles is None or cycles < max_cycles:
+        time.sleep(interval)
+        current = find_metaf_files(root_dir)
+        if current == mtimes:
+            continue
+        while True:
+            time.sleep(debounce)
+            settled = find_metaf_files(root_dir)
+            if settled == current:
+                break
+            current = settled
+        changed = [path for path, mtime in current.items() if mtimes.get(path) != mtime]
+        mtimes = current
+        if changed:
+            start = time.perf_counter()
+            results = find_and_generate_metaf_files(
+                root_dir, jobs, paths=changed, stats=stats, graph=graph
+            )
+            _summarize(results, time.perf_counter() - start)
+            cycles += 1
+
+
+def _summarize(results: list[ScriptResult], seconds: float) -> list[str]:
+    failed = [result.path for result in results if not result.ok]
+    print(
+        f"Generated {len(results) - len(failed)} of {len(results)} scripts "
+        f"in {seconds:.3f}s"
+    )
+    for path in failed:
+        print(f"Failed: {path}")
+    return failed
+
+
+def _report(result: ScriptResult) -> ScriptResult:
+    print(f"In file {result.path}")
+    if result.output:
+        print(result.output, end="" if result.output.endswith("\n") else "\n")
+    if result.cached:
+        print("  cached")
+    else:
+        print(f"  {'ok' if result.ok else 'FAILED'} in {result.seconds:.3f}s")
+    if result.stats:
+        from metaform.stats import summarize
+
+        for build_stats in result.stats:
+            print(f"  {summarize(build_stats)}")
+    return result
+
+
+def main() -> int:
     parser = ArgumentParser()
     parser.add_argument("--chdir", type=str, default=".")
     parser.add_argument("--version", "-v", action="store_true")
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=1, help="number of scripts to run at once"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="ignore the build cache and run all scripts",
+    )
+    parser.add_argument(
+        "--watch", action="store_true", help="regenerate scripts as they change"
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.5,
+        help="seconds between polls in watch mode",
+    )
+    parser.add_argument(
+        "--stats", action="store_true", help="print timings and counts for each build"
+    )
+    parser.add_argument(
+        "--graph",
+        choices=["dot", "json"],
+        help="write each build's dependency graph and parallelism metrics "
+        "next to its output",
+    )
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["bench"],
+        help="run the benchmark suite instead of generating scripts",
+    )
+    bench = parser.add_argument_group("bench")
+    bench.add_argument("--scale", type=float, default=1.0)
+    bench.add_argument("--scenario", action="append", help="wide, deep, nested or maps")
+    bench.add_argument("--output", type=str, help="save results as JSON")
+    bench.add_argument("--compare", type=str, help="JSON results to compare against")
+    bench.add_argument("--no-memory", action="store_true")
     args = parser.parse_args()
     if args.version:
-        print("metaform 0.1.0")
-    else:
-        find_and_generate_metaf_files(args.chdir)
+        print(f"metaform {__version__}")
+        return 0
+    if args.command == "bench":
+        from metaform.bench import SCENARIOS, main as bench_main
+
+        unknown = sorted(set(args.scenario or ()).difference(SCENARIOS))
+        if unknown:
+            parser.error(f"unknown scenario {', '.join(unknown)}")
+        return bench_main(args)
+    start = time.perf_counter()
+    results = find_and_generate_metaf_files(
+        args.chdir, args.jobs, args.force, stats=args.stats, graph=args.graph
+    )
+    failed = _summarize(results, time.perf_counter() - start)
+    if args.watch:
+        print(f"Watching {args.chdir} for changes, press Ctrl-C to stop")
+        try:
+            watch_metaf_files(
+                args.chdir,
+                args.jobs,
+                args.interval,
+                stats=args.stats,
+                graph=args.graph,
+            )
+        except KeyboardInterrupt:
+            return 0
+    return 1 if failed else 0
@@ -1,6 +1,10 @@
 from metaform.blocks import (
     Block,
     BlockError,
+    Caller,
+    DependencyError,
+    _NO_DEPENDENCIES,
+    _PLAIN_VALUES,
     _VARIABLE,
     _DATA,
     _MODULE,
@@ -10,48 +14,468 @@ from metaform.blocks import (
     _PROVIDER,
     _MAP,
 )
-from typing import Union, Optional
-import itertools
-import functools
+from metaform.stats import BuildStats, phase
+from metaform import tfjson
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from metaform.cache import file_stat
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    Union,
+    Optional,
+)
+import contextvars
+import hashlib
+import io
+import json
 import os
+import threading
 
-
-class DependencyError(Exception):
-    """
-    Exception to return due to issues resolving dependencies
-    """
+if TYPE_CHECKING:
+    from metaform.graph import DependencyGraph
+    from metaform.template import Template
 
 
 def resolve_dependencies(
     dependency_map: dict[str, set[str]], base_layer: set[str] = set()
 ) -> list[set[str]]:
+    """
+    Group blocks into layers where every block only depends on blocks in earlier
+    layers (or in base_layer), using in-degree counters and a reverse-edge index
+    """
+    in_degree = {}
+    dependents = {block: [] for block in dependency_map}
+    for block, deps in dependency_map.items():
+        if block in base_layer:
+            continue
+        pending = set(deps).difference(base_layer)
+        for dep in pending:
+            if dep not in dependents:
+                raise DependencyError(
+                    f"Unable to resolve dependencies, block {block} depends on {dep} which is not registered."
+                )
+            dependents[dep].append(block)
+        in_degree[block] = len(pending)
+
     layers = []
-    total_blocks = set(dependency_map.keys())
-    while base_layer != total_blocks:
-        next_layer = set(
-            block
-            for block in dependency_map
-            if dependency_map[block].issubset(base_layer)
-        )
-        current_layer = next_layer - base_layer
+    resolved = 0
+    current_layer = {block for block, degree in in_degree.items() if not degree}
+    while current_layer:
         layers.append(current_layer)
-        base_layer = next_layer
-        if not current_layer:
-            raise DependencyError(
-                "Unable to resolve dependencies, ensure they are consistent and non-circular."
-            )
+        resolved += len(current_layer)
+        next_layer = set()
+        for block in current_layer:
+            for dependent in dependents[block]:
+                in_degree[dependent] -= 1
+                if not in_degree[dependent]:
+                    next_layer.add(dependent)
+        current_layer = next_layer
+
+    if resolved != len(in_degree):
+        cycle = _find_cycle(dependency_map, in_degree)
+        raise DependencyError(
+            f"Unable to resolve dependencies, circular dependency found: {' -> '.join(cycle)}"
+        )
     return layers
 
 
+def _find_cycle(
+    dependency_map: dict[str, set[str]], in_degree: dict[str, int]
+) -> list[str]:
+    """
+    Walk unresolved dependencies from an unresolved block until a block repeats
+    """
+    unresolved = {block for block, degree in in_degree.items() if degree}
+    path = []
+    seen = {}
+    block = min(unresolved)
+    while block not in seen:
+        seen[block] = len(path)
+        path.append(block)
+        block = min(dep for dep in dependency_map[block] if dep in unresolved)
+    return path[seen[block] :] + [block]
+
+
+def replace_file(
+    path: str,
+    write: Callable[[IO], None],
+    replace: Optional[Callable[[], bool]] = None,
+) -> bool:
+    """
+    Atomically replace the file at path with whatever write puts in a temporary
+    file next to it, keeping the permissions of the file being replaced. New
+    files are created like open() would, with the permissions the umask allows.
+    When replace() returns False once the content is written, the file is left
+    alone instead. Returns whether it was replaced
+    """
+    try:
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = None
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            write(f)
+        if replace is not None and not replace():
+            os.unlink(tmp_path)
+            return False
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return True
+
+
+def write_if_changed(path: str, content: str) -> bool:
+    """
+    Atomically replace the file at path with content unless it already matches
+    """
+    try:
+        with open(path, "r") as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    replace_file(path, lambda f: f.write(content))
+    return True
+
+
+class BuildResult(NamedTuple):
+    """
+    Block ids added, removed and modified since the previous build, whether any
+    file was written, the files the build produces and the BuildStats when the
+    build was instrumented
+    """
+
+    added: list[str]
+    removed: list[str]
+    modified: list[str]
+    written: bool
+    paths: tuple[str, ...] = ()
+    stats: Optional[BuildStats] = None
+
+
+class BuildSession:
+    """
+    Defaults for the builds run inside build_session() and their results, e.g.
+    every build of a script run by mf. Functions in callbacks are called with the
+    BuildStats of every instrumented build as it finishes, e.g. to export them
+    """
+
+    def __init__(
+        self,
+        stats: bool = False,
+        graph: Optional[str] = None,
+        callbacks: Iterable[Callable[[BuildStats], None]] = (),
+    ):
+        self.stats = stats
+        self.graph = graph
+        self.callbacks = list(callbacks)
+        self.results = []
+
+    def record(self, result: BuildResult):
+        self.results.append(result)
+        if result.stats is not None:
+            for callback in self.callbacks:
+                callback(result.stats)
+
+    @property
+    def paths(self) -> list[str]:
+        return [path for result in self.results for path in result.paths]
+
+
+_session = contextvars.ContextVar("metaform_build_session", default=None)
+
+
+@contextmanager
+def build_session(
+    stats: bool = False,
+    graph: Optional[str] = None,
+    on_build: Optional[Callable[[BuildStats], None]] = None,
+) -> Iterator[BuildSession]:
+    """
+    Record the result of every build run in the with block, which records
+    BuildStats when stats is set and writes the dependency graph as graph ("dot"
+    or "json") unless the build is told otherwise. on_build is called with the
+    BuildStats of every instrumented build as it finishes, on the thread that
+    ran it. Sessions belong to the current context, so concurrent threads and
+    tasks each see their own
+    """
+    session = BuildSession(stats, graph, [on_build] if on_build else ())
+    token = _session.set(session)
+    try:
+        yield session
+    finally:
+        _session.reset(token)
+
+
 class Registry(dict):
     def __init__(self):
         super(Registry, self).__init__()
+        self.positions = {}  # registration order of every block id
+        self.dependents = {}  # reverse dependency index: block id -> dependent ids
+        self.depends_on = {}  # dependency index: block id -> ids it depends on
+        self.levels = {}  # dependency layer of blocks whose dependencies resolve
+        self.namespaces = {}  # registries of the stacks sharing this one
+        self.lock = threading.RLock()  # guards the blocks and every index
 
     def __setitem__(self, block_id: str, block: Block):
         if isinstance(block, Block):
-            super(Registry, self).__setitem__(block_id, block)
+            dep_ids = {str(dep_block) for dep_block in block.dependencies}
+            with self.lock:
+                if block_id in self.dependents or block_id in self:
+                    self._check_cycle(block_id, dep_ids)
+                    super(Registry, self).__setitem__(block_id, block)
+                    self.positions.setdefault(block_id, len(self.positions))
+                    block._registry = self
+                    self._reindex(block_id, dep_ids)
+                else:
+                    self._add(block_id, block, dep_ids)
         return self
 
+    def _add(self, block_id: str, block: Block, dep_ids: set[str]):
+        """
+        Register a new block nothing depends on yet, which can not close a cycle
+        and only needs its own entries in the indexes
+        """
+        super(Registry, self).__setitem__(block_id, block)
+        self.positions[block_id] = len(self.positions)
+        block._registry = self
+        level = 0
+        if dep_ids:
+            self.depends_on[block_id] = dep_ids
+            for dep_id in dep_ids:
+                self.dependents.setdefault(dep_id, set()).add(block_id)
+                dep_level = self.levels.get(dep_id)
+                if level is not None:
+                    level = None if dep_level is None else max(level, dep_level + 1)
+        if level is not None:  # otherwise no layer until its dependencies register
+            self.levels[block_id] = level
+
+    def __delitem__(self, block_id: str):
+        with self.lock:
+            super(Registry, self).__delitem__(block_id)
+            self._reindex(block_id, set())
+            self.levels.pop(block_id, None)
+            for dependent in list(self.dependents.get(block_id, ())):
+                self._relevel(dependent)
+
+    def register(
+        self, blocks: Iterable[Block], ignore_duplicates: bool = False
+    ) -> list[Block]:
+        """
+        Register blocks under their ids, raising BlockError without registering
+        any of them if one is already registered. The check and the registration
+        happen under the lock, so concurrent callers can not both register an id
+        """
+        blocks = {str(block): block for block in blocks}
+        with self.lock:
+            if not ignore_duplicates:
+                duplicates = sorted(self.keys() & blocks.keys())
+                if duplicates:
+                    raise BlockError(
+                        f"Blocks {', '.join(duplicates)} are already registered in the block registry."
+                    )
+            for block_id, block in blocks.items():
+                self[block_id] = block
+        return list(blocks.values())
+
+    def flush(self):
+        """
+        Persist the registered blocks, called at the end of every build. Blocks
+        held in memory have nowhere to be written
+        """
+
+    def namespace(self, name: str) -> "Registry":
+        """
+        Returns the registry of the stack called name, created on first use. Each
+        namespace has its own lock and indexes, so stacks registering and
+        building in different namespaces never wait on each other
+        """
+        with self.lock:
+            registry = self.namespaces.get(name)
+            if registry is None:
+                registry = self.namespaces[name] = Registry()
+            return registry
+
+    def _block_changed(self, block: Block, dependencies: set[Block]):
+        """
+        Called by a registered block before its properties change, with the
+        dependencies it has afterwards
+        """
+        if dependencies == block.dependencies:
+            return
+        block_id = str(block)
+        with self.lock:
+            if super(Registry, self).get(block_id, None) is block:
+                dep_ids = {str(dep_block) for dep_block in dependencies}
+                self._check_cycle(block_id, dep_ids)
+                self._reindex(block_id, dep_ids)
+
+    def _check_cycle(self, block_id: str, dep_ids: set[str]):
+        if block_id in dep_ids:
+            cycle = [block_id, block_id]
+        else:
+            cycle = self._cycle_through(
+                block_id, {dep_id for dep_id in dep_ids if dep_id in self}
+            )
+        if cycle:
+            raise DependencyError(
+                f"Unable to register {block_id}, circular dependency found: {' -> '.join(cycle)}"
+            )
+
+    def _cycle_through(self, block_id: str, targets: set[str]) -> Optional[list[str]]:
+        """
+        Returns the cycle block_id depending on one of targets would close, found
+        by searching from block_id through the dependents index. Blocks reached
+        that way sit in higher layers than block_id, so blocks at or above the
+        highest layer of the targets are not searched further
+        """
+        if not targets or not self.dependents.get(block_id):
+            return None
+        levels = [self.levels.get(target) for target in targets]
+        bound = None if None in levels else max(levels)
+        level = self.levels.get(block_id)
+        if bound is not None and level is not None and bound <= level:
+            return None
+        parents = {block_id: None}
+        stack = [block_id]
+        while stack:
+            node = stack.pop()
+            for dependent in self.dependents.get(node, ()):
+                if dependent in parents:
+                    continue
+                parents[dependent] = node
+                if dependent in targets:
+                    cycle = [block_id]
+                    while dependent is not None:
+                        cycle.append(dependent)
+                        dependent = parents[dependent]
+                    return cycle
+                level = self.levels.get(dependent)
+                if bound is None or level is None or level < bound:
+                    stack.append(dependent)
+        return None
+
+    def _reindex(self, block_id: str, dep_ids: set[str]):
+        previous = self.depends_on.get(block_id, set())
+        for dep_id in previous - dep_ids:
+            self.dependents[dep_id].discard(block_id)
+        for dep_id in dep_ids - previous:
+            self.dependents.setdefault(dep_id, set()).add(block_id)
+        if dep_ids:
+            self.depends_on[block_id] = dep_ids
+        else:
+            self.depends_on.pop(block_id, None)
+        if block_id in self:
+            self._relevel(block_id)
+
+    def _relevel(self, block_id: str):
+        """
+        Recompute the layer of block_id, one past its deepest dependency, and of
+        the blocks depending on it whose layer changes as a result. Blocks with
+        an unregistered dependency have no layer until it is registered
+        """
+        stack = [block_id]
+        while stack:
+            node = stack.pop()
+            level = 0
+            for dep_id in self.depends_on.get(node, ()):
+                dep_level = self.levels.get(dep_id)
+                if dep_level is None:
+                    level = None
+                    break
+                level = max(level, dep_level + 1)
+            if level != self.levels.get(node):
+                if level is None:
+                    del self.levels[node]
+                else:
+                    self.levels[node] = level
+                stack.extend(self.dependents.get(node, ()))
+
+    def unresolved(self, block_id: str) -> DependencyError:
+        """
+        Returns the error for a block without a layer, naming the unregistered
+        block it transitively depends on
+        """
+        stack = [block_id]
+        while stack:
+            node = stack.pop()
+            for dep_id in sorted(self.depends_on.get(node, ())):
+                if dep_id not in self:
+                    return DependencyError(
+                        f"Unable to resolve dependencies, block {node} depends on {dep_id} which is not registered."
+                    )
+                stack.append(dep_id)
+        return DependencyError(f"Unable to resolve dependencies of block {block_id}.")
+
+    def _tracking(self, group: str) -> dict:
+        """
+        Returns the mapping in which a Group keeps the blocks it created
+        """
+        return {}
+
+    def groups(
+        self, block_ids: Optional[Iterable[str]] = None
+    ) -> Iterator[tuple[str, str]]:
+        """
+        Returns the id and group of the given blocks, or of every block in
+        registration order
+        """
+        if block_ids is None:
+            return ((block_id, block._group) for block_id, block in self.items())
+        get = super(Registry, self).__getitem__
+        return ((block_id, get(block_id)._group) for block_id in block_ids)
+
+    def blocks_of(self, block_ids: Iterable[str]) -> Iterator[Block]:
+        """
+        Returns the registered blocks with the given ids, in order
+        """
+        return map(super(Registry, self).__getitem__, block_ids)
+
+    def dependencies_of(self, block_ids: Iterable[str]) -> list[str]:
+        """
+        Returns the given blocks and everything they transitively depend on, in
+        registration order, visiting only that subgraph
+        """
+        return self._closure(
+            block_ids, lambda block_id: self.depends_on.get(block_id, ())
+        )
+
+    def dependents_of(self, block_ids: Iterable[str]) -> list[str]:
+        """
+        Returns the given blocks and everything that transitively depends on them,
+        in registration order, using the reverse dependency index
+        """
+        return self._closure(
+            block_ids, lambda block_id: self.dependents.get(block_id, ())
+        )
+
+    def _closure(
+        self, block_ids: Iterable[str], edges: Callable[[str], Iterable[str]]
+    ) -> list[str]:
+        seen = set()
+        stack = [str(block_id) for block_id in block_ids]
+        while stack:
+            block_id = stack.pop()
+            if block_id not in seen:
+                if block_id not in self:
+                    raise BlockError(
+                        f"Block {block_id} is not registered in the registry."
+                    )
+                seen.add(block_id)
+                stack.extend(edges(block_id))
+        return sorted(seen, key=self.positions.__getitem__)
+
     def __getitem__(self, block_id: str) -> Block:
         block = super(Registry, self).get(block_id, None)
         if block:
@@ -72,19 +496,21 @@ class Group:
     def __init__(self, group: str, registry: Registry):
         self.group = group
         self.registry = registry
-        self.blocks = {}
+        self.blocks = registry._tracking(group)
 
     def __getitem__(self, block_id: str) -> Block:
         return self.blocks[block_id]
 
     def _update_tracking_and_return(self, new_block: Block):
-        self.blocks[str(new_block)] = new_block
-        if (str(new_block) not in self.registry) or self._ignore_duplicates:
-            self.registry[str(new_block)] = new_block
-        else:
-            raise BlockError(
-                f"Block {new_block} is already registered in the block registry."
-            )
+        block_id = str(new_block)
+        self.blocks[block_id] = new_block
+        with self.registry.lock:
+            if (block_id not in self.registry) or self._ignore_duplicates:
+                self.registry[block_id] = new_block
+            else:
+                raise BlockError(
+                    f"Block {new_block} is already registered in the block registry."
+                )
         return new_block
 
     def __call__(
@@ -95,6 +521,104 @@ class Group:
         new_block = Block(self.group, *ids, **kwargs)
         return self._update_tracking_and_return(new_block)
 
+    def bulk(
+        self,
+        *args: Union[str, Iterable[dict], dict[str, list]],
+        id_field: str = "id",
+        for_each: Optional[str] = None,
+    ) -> Union[list[Block], Block]:
+        """
+        Create one block per row, e.g. tf.resource.bulk("aws_ssm_parameter", rows).
+        Rows are dicts (or a dict of columns) whose id_field value is the last id
+        of the block, and are registered after a single duplicate check. With
+        for_each, the rows are instead collapsed into one block of that name
+        which iterates over them with Terraform's for_each
+        """
+        *ids, rows = args
+        if isinstance(rows, dict):
+            lengths = {column: len(values) for column, values in rows.items()}
+            if len(set(lengths.values())) > 1:
+                raise BlockError(
+                    f"Columns of bulk rows must have the same length, got {lengths}."
+                )
+            rows = [dict(zip(rows, values)) for values in zip(*rows.values())]
+        if for_each is not None:
+            return self._update_tracking_and_return(
+                self._for_each_block(ids, rows, id_field, for_each)
+            )
+
+        new_blocks = {}
+        duplicates = set()
+        for row in rows:
+            new_block = self._row_block(ids, row, id_field)
+            block_id = new_block._key
+            if block_id in new_blocks:
+                duplicates.add(block_id)
+            new_blocks[block_id] = new_block
+        if duplicates:
+            raise BlockError(
+                f"Blocks {', '.join(sorted(duplicates))} are already registered in the block registry."
+            )
+        self.registry.register(new_blocks.values(), self._ignore_duplicates)
+        self.blocks.update(new_blocks)
+        return list(new_blocks.values())
+
+    def _row_block(self, ids: list[str], row: dict, id_field: str) -> Block:
+        """
+        Create the block for a row without going through Block.__init__, only
+        looking for dependencies in rows with values other than plain scalars
+        """
+        self._check_row(row, id_field)
+        block = Block._assemble(
+            self.group,
+            *Block._group_id_reprs(self.group, (*ids, str(row[id_field]))),
+        )
+        properties = block._properties
+        dict.update(properties, row)
+        dict.__delitem__(properties, id_field)
+        if not _PLAIN_VALUES.issuperset(map(type, properties.values())):
+            block.dependencies = block._find_dependencies() or _NO_DEPENDENCIES
+        return block
+
+    @staticmethod
+    def _check_row(row: dict, id_field: str):
+        if id_field not in row:
+            raise BlockError(f"Row {row} has no {id_field} to use as its id.")
+
+    def _for_each_block(
+        self, ids: list[str], rows: Iterable[dict], id_field: str, name: str
+    ) -> Block:
+        """
+        Create one block iterating over the rows, kept as plain maps of each row's
+        values by its id in a for_each argument the block's properties refer to
+        """
+        instances = {}
+        columns = None
+        plain = True
+        for row in rows:
+            self._check_row(row, id_field)
+            values = dict(row)
+            instances[str(values.pop(id_field))] = values
+            if columns is None:
+                columns = list(values)
+            elif list(values) != columns:
+                raise BlockError(
+                    f"Rows of for_each block {name} must share properties."
+                )
+            plain = plain and _PLAIN_VALUES.issuperset(map(type, values.values()))
+        block = Block._assemble(
+            self.group,
+            *Block._group_id_reprs(self.group, (*ids, name)),
+            tomap=False,
+        )
+        properties = block._properties
+        for column in columns or ():
+            dict.__setitem__(properties, column, Caller("each.value", column))
+        dict.__setitem__(properties, "for_each", instances)
+        if not plain:
+            block.dependencies = block._find_dependencies() or _NO_DEPENDENCIES
+        return block
+
 
 class Providers:
     _ignore_duplicates = False
@@ -123,12 +647,14 @@ class Providers:
         provider_options = Block(
             _MAP, provider, tomap=False, invisible_map=True, **required_provider_params
         )
-        if (str(provider_block) not in self.registry) or self._ignore_duplicates:
-            self.registry[str(provider_block)] = provider_block
-        else:
-            raise BlockError(
-                f"Provider {provider} is already registered in the block registry."
-            )
+        with self.registry.lock:
+            if (str(provider_block) not in self.registry) or self._ignore_duplicates:
+                self.registry[str(provider_block)] = provider_block
+                self.blocks[str(provider_block)] = provider_block
+            else:
+                raise BlockError(
+                    f"Provider {provider} is already registered in the block registry."
+                )
         self.provider_options[provider] = provider_options
 
     def add(
@@ -161,20 +687,37 @@ class MetaFormer:
         _MODULE,
         _OUTPUT,
     ]
+    _COMPONENT_RANK = {group: rank for rank, group in enumerate(_COMPONENT_ORDER)}
+    _SPLIT_FILES = {
+        _PROPERTY: "providers",
+        _PROVIDER: "providers",
+        _VARIABLE: "variables",
+        _DATA: "data",
+        _RESOURCE: "resources",
+        _MODULE: "modules",
+        _OUTPUT: "outputs",
+    }
+    _FORMAT_SUFFIXES = {"hcl": ".tf", "json": ".tf.json"}
+    _GRAPH_FORMATS = ("dot", "json")
 
     def __init__(
         self,
         name: str = "main",
         isolate_module: bool = False,
-        split_out: bool = False,  # here to specify whether to split Metaform registry into multiple tf files
+        split_out: Union[bool, Callable[[Block], str]] = False,
         registry: Optional[Registry] = None,
+        namespace: Optional[str] = None,
     ):
         if registry is not None:
             self.registry = registry
         else:
             self.registry = Registry()
+        if namespace is not None:
+            # blocks go to the stack's own namespace of the (shared) registry
+            self.registry = self.registry.namespace(namespace)
         self.name = name
         self.isolate_module = isolate_module
+        self.split_out = split_out  # True shards by component, a callable by its key
 
         # create major componenets
         self.data = Group("data", self.registry)
@@ -193,53 +736,481 @@ class MetaFormer:
         self.prop = self.property
         self.prov = self.provider
 
+    def template(self, fn: Callable[..., Any]) -> "Template":
+        """
+        Record the blocks fn(tf, **params) defines once and return a Template
+        stamping a copy of them into this MetaFormer for every call with params,
+        e.g. bucket = tf.template(make_bucket); bucket(name="logs")
+        """
+        from metaform.template import Template
+
+        return Template(self, fn)
+
+    def graph(
+        self, targets: Optional[Iterable[Union[Block, str]]] = None
+    ) -> "DependencyGraph":
+        """
+        Returns the dependency graph of the registered blocks, or of the targets
+        and what they depend on, with its layer widths, critical path and fan-in
+        and fan-out hotspots, exportable with to_dot() and to_json()
+        """
+        from metaform.graph import DependencyGraph
+
+        if targets is None:
+            block_ids = None
+        else:
+            block_ids = self.registry.dependencies_of(map(str, targets))
+        with self.registry.lock:
+            return DependencyGraph(self.registry, block_ids, self.name)
+
     def _clear_registry(self):
         self.registry = Registry()
         return self
 
-    def _collect_dependencies(self) -> dict[str, set[str]]:
+    def _collect_dependencies(
+        self, blocks: Optional[Iterable[tuple[str, Block]]] = None
+    ) -> dict[str, set[str]]:
         return {
             block_id: {str(dep_block) for dep_block in block.dependencies}
-            for block_id, block in self.registry.items()
+            for block_id, block in (self.registry.items() if blocks is None else blocks)
             if block._group != _PROPERTY
         }
 
+    def _targeted(self, targets: Iterable[Union[Block, str]]) -> list[str]:
+        """
+        Returns the targets, the providers and everything they depend on
+        """
+        block_ids = list(map(str, targets)) + list(self.provider.blocks)
+        return self.registry.dependencies_of(block_ids)
+
     def _resolve_dependencies(self) -> list[set[str]]:
         return resolve_dependencies(self._collect_dependencies())
 
-    def collect(self) -> list[Block]:
-        dependencies = self._resolve_dependencies()
-        return [self.provider.build_provider()] + functools.reduce(
-            lambda m, n: self._sort(set(m)) + self._sort(set(n)), dependencies, []
-        )
+    def iter_collect(
+        self,
+        stats: Optional[BuildStats] = None,
+        targets: Optional[Iterable[Union[Block, str]]] = None,
+    ) -> Iterator[Block]:
+        """
+        Yield the blocks layer by layer, ordered within each layer as:
+            PROVIDERS -> VARIABLES -> DATA -> RESOURCES -> MODULES -> OUTPUTS
+        Blocks in the same layer and group keep their registration order. With
+        targets, only they, the providers and their dependencies are collected
+        """
+        yield self.provider.build_provider()
+        yield from self.registry.blocks_of(self._collect_ids(stats, targets))
 
-    def _sort(self, deps: set[Block]) -> list[Block]:
+    def _collect_ids(
+        self,
+        stats: Optional[BuildStats] = None,
+        targets: Optional[Iterable[Union[Block, str]]] = None,
+    ) -> list[str]:
         """
-        Sort the dependencies putting in the following order:
-            VARIABLES -> DATA -> RESOURCES -> MODULES -> OUTPUTS
+        Returns the ids of the blocks iter_collect yields after the providers,
+        sorted from the registry's indexes alone, so that registries keeping
+        their blocks out of memory only page them in as they are yielded
         """
-        deps = {self.registry[str(block_id)] for block_id in deps}
-        ordered = [
-            list(filter(lambda b: b._group == comp, deps))
-            for comp in self._COMPONENT_ORDER
-        ] + [list(filter(lambda b: b._group not in self._COMPONENT_ORDER, deps))]
-        return list(itertools.chain(*ordered))
+        with self.registry.lock:  # blocks registered meanwhile wait for the sort
+            with phase(stats, "dependencies"):
+                if targets is None:
+                    groups = self.registry.groups()
+                else:
+                    groups = self.registry.groups(self._targeted(targets))
+            with phase(stats, "sort"):
+                levels = self.registry.levels
+                others = len(self._COMPONENT_ORDER)
+                buckets = []
+                for block_id, group in groups:
+                    if group == _PROPERTY:
+                        continue
+                    level = levels.get(block_id)
+                    if level is None:
+                        raise self.registry.unresolved(block_id)
+                    while len(buckets) <= level:
+                        buckets.append([[] for _ in range(others + 1)])
+                    rank = self._COMPONENT_RANK.get(group, others)
+                    buckets[level][rank].append(block_id)
+                    if stats is not None:
+                        stats.blocks[group] = stats.blocks.get(group, 0) + 1
+        if stats is not None:
+            stats.layers = len(buckets)
+            stats.widest_layer = max(
+                (sum(map(len, layer)) for layer in buckets), default=0
+            )
+        return [block_id for layer in buckets for ids in layer for block_id in ids]
+
+    def collect(
+        self, targets: Optional[Iterable[Union[Block, str]]] = None
+    ) -> list[Block]:
+        return list(self.iter_collect(targets=targets))
+
+    def _check_format(self, format: str):
+        if format not in self._FORMAT_SUFFIXES:
+            raise ValueError(f"Unknown format {format}, expected hcl or json.")
+
+    def _check_graph(self, graph: Optional[str]):
+        if graph is not None and graph not in self._GRAPH_FORMATS:
+            raise ValueError(f"Unknown graph format {graph}, expected dot or json.")
+
+    def iter_write(
+        self,
+        stats: Optional[BuildStats] = None,
+        format: str = "hcl",
+        targets: Optional[Iterable[Union[Block, str]]] = None,
+    ) -> Iterator[str]:
+        """
+        Yield the contents of the MetaForm object one rendered block at a time, as
+        HCL or as Terraform JSON
+        """
+        self._check_format(format)
+        yield from self._render(self.iter_collect(stats, targets), stats, format)
+
+    def _render(
+        self,
+        blocks: Iterable[Block],
+        stats: Optional[BuildStats],
+        format: str,
+        record: Optional[Callable[[Block, str], None]] = None,
+    ) -> Iterator[str]:
+        """
+        Yield the rendered blocks, passing each block and its rendering to record
+        """
+        if format == "json":
+            yield from tfjson.iter_encode(blocks, record, self.registry)
+            return
+        for index, block in enumerate(blocks):
+            with phase(stats, "render"):
+                rendered = block._write()
+            if record is not None:
+                with phase(stats, "hash"):
+                    record(block, rendered)
+            yield "\n\n" + rendered if index else rendered
 
     def _write(self):
         """
         Return the contents of the MetaForm object as a string
         """
-        return "\n\n".join(block._write() for block in self.collect())
+        return "".join(self.iter_write())
+
+    def _stream(
+        self,
+        stream: IO,
+        chunks: Iterable[str],
+        stats: Optional[BuildStats] = None,
+        name: Optional[str] = None,
+    ):
+        """
+        Write the rendered chunks incrementally to a text or binary file-like object
+        """
+        if isinstance(stream, io.RawIOBase):
+            buffered = io.BufferedWriter(stream)
+            self._stream(buffered, chunks, stats, name)
+            buffered.detach()
+            return
+        binary = isinstance(stream, io.BufferedIOBase) or "b" in getattr(
+            stream, "mode", ""
+        )
+        written = 0
+        for chunk in chunks:
+            with phase(stats, "write"):
+                data = chunk.encode() if binary else chunk
+                stream.write(data)
+                if stats is not None:
+                    written += len(data) if binary else len(data.encode())
+        stream.flush()
+        if stats is not None:
+            name = name or str(getattr(stream, "name", "<stream>"))
+            stats.files[name] = stats.files.get(name, 0) + written
 
-    def build(self):
+    def build(
+        self,
+        stream: Optional[IO] = None,
+        stats: Optional[bool] = None,
+        format: str = "hcl",
+        targets: Optional[Iterable[Union[Block, str]]] = None,
+        graph: Optional[str] = None,
+    ) -> BuildResult:
         """
-        Build out the new terraform scripts from the metaform commands
+        Build out the new terraform scripts from the metaform commands, or write
+        them to the given file-like object instead. format="json" writes Terraform
+        JSON (.tf.json) instead of HCL, and targets limits the output to the given
+        blocks, the providers and what they depend on.
+
+        Files are only rewritten when a block changed since the previous build,
+        which is tracked through a hash of every block in .{name}.metaform-hashes
+        next to the output. Builds to a stream are not tracked, so their result
+        lists no added, removed or modified blocks. With stats, the BuildStats of
+        the build are returned in the result. With graph set to "dot" or "json",
+        the dependency graph is written next to the output as well. Inside
+        build_session(), stats and graph default to the session's and the result
+        is added to it. The registry is flushed once the build is done
         """
+        session = _session.get()
+        if session is not None:
+            stats = session.stats if stats is None else stats
+            graph = session.graph if graph is None else graph
+        self._check_format(format)
+        self._check_graph(graph)
+        build_stats = BuildStats(self.name) if stats else None
+        with phase(build_stats, "build"):
+            result = self._build(stream, build_stats, format, targets, graph)
+        self.registry.flush()
+        result = result._replace(stats=build_stats)
+        if session is not None:
+            session.record(result)
+        return result
+
+    def _build(
+        self,
+        stream: Optional[IO],
+        stats: Optional[BuildStats],
+        format: str,
+        targets: Optional[Iterable[Union[Block, str]]],
+        graph: Optional[str],
+    ) -> BuildResult:
+        terraform = self.provider.build_provider()
+        block_ids = self._collect_ids(stats, targets)
+
+        def blocks() -> Iterator[Block]:
+            # paged in again on every pass rather than held in a list
+            yield terraform
+            yield from self.registry.blocks_of(block_ids)
+
+        hashes = {}
+
+        def record(block: Block, rendered: str):
+            hashes[str(block)] = hashlib.sha1(rendered.encode()).hexdigest()
+
+        if stream is not None:  # nothing to compare against, so nothing to hash
+            self._stream(stream, self._render(blocks(), stats, format), stats)
+            return BuildResult([], [], [], True)
+
+        suffix = self._FORMAT_SUFFIXES[format]
+        directory, name = os.path.split(self.name)
         if self.isolate_module:
             main_path = os.path.join(os.path.realpath("__main__"), self.name)
-            os.mkdir(main_path)
-            with open(os.path.join(main_path, "main.tf"), "w") as f:
-                f.write(self._write())
+            os.makedirs(main_path, exist_ok=True)
+            path = os.path.join(main_path, f"main{suffix}")
+        else:
+            main_path = directory or "."
+            path = f"{self.name}{suffix}"
+        hashes_path = os.path.join(main_path, f".{name}.metaform-hashes")
+        if self.split_out:
+            shards = {}
+            for block in blocks():
+                shards.setdefault(self._shard(block), []).append(block)
+                hashes[str(block)] = None  # block order, shards render concurrently
+            paths = sorted(os.path.join(main_path, shard + suffix) for shard in shards)
+            self._check_shards(main_path, hashes_path, paths)
         else:
-            with open(f"{self.name}.tf", "w") as f:
-                f.write(self._write())
+            paths = [path]
+        outputs = list(paths)
+        if graph is not None:
+            outputs.append(self._graph_path(path[: -len(suffix)], graph))
+        previous = self._load_hashes(hashes_path)
+        previous_hashes = previous.get("blocks", {})
+
+        def changed() -> bool:
+            return not (
+                previous.get("format") == format
+                and list(previous_hashes.items()) == list(hashes.items())
+                and list(previous.get("files", {})) == outputs
+                and all(
+                    file_stat(file_path) == file_stats
+                    for file_path, file_stats in previous["files"].items()
+                )
+            )
+
+        # every block is rendered once, hashed as it is written to a temporary
+        # file or shard, which are only put in place if anything changed
+        if self.split_out:
+            contents = self._render_split(main_path, shards, stats, format, record)
+            written = changed()
+            if written:
+                self._write_split(contents, stats)
+        else:
+            written = replace_file(
+                path,
+                lambda f: self._stream(
+                    f, self._render(blocks(), stats, format, record), stats, path
+                ),
+                changed,
+            )
+            if not written and stats is not None:
+                stats.files.pop(path, None)
+        result = BuildResult(
+            added=[block_id for block_id in hashes if block_id not in previous_hashes],
+            removed=[
+                block_id for block_id in previous_hashes if block_id not in hashes
+            ],
+            modified=[
+                block_id
+                for block_id, block_hash in hashes.items()
+                if previous_hashes.get(block_id, block_hash) != block_hash
+            ],
+            written=written,
+            paths=tuple(outputs),
+        )
+        if not written:
+            return result
+
+        if graph is not None:
+            self._write_graph(outputs[-1], targets, graph)
+        for file_path in previous.get("files", {}):
+            if file_path not in outputs:  # shards or graphs no longer produced
+                try:
+                    os.unlink(file_path)
+                except FileNotFoundError:
+                    pass
+        replace_file(
+            hashes_path,
+            lambda f: json.dump(
+                {
+                    "format": format,
+                    "blocks": hashes,
+                    "files": {file_path: file_stat(file_path) for file_path in outputs},
+                },
+                f,
+            ),
+        )
+        return result
+
+    def _graph_path(self, base: str, graph: str) -> str:
+        """
+        Returns where build writes the dependency graph, next to the output as
+        {base}.graph.dot or {base}.graph.json
+        """
+        return f"{base}.graph.{graph}"
+
+    def _write_graph(
+        self,
+        path: str,
+        targets: Optional[Iterable[Union[Block, str]]],
+        graph_format: str,
+    ):
+        graph = self.graph(targets)
+        chunks = graph.iter_dot() if graph_format == "dot" else graph.iter_json()
+        replace_file(path, lambda f: f.writelines(chunks))
+
+    def _load_hashes(self, hashes_path: str) -> dict:
+        try:
+            with open(hashes_path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _shard(self, block: Block) -> str:
+        if callable(self.split_out):
+            return self.split_out(block)
+        return self._SPLIT_FILES.get(block._group, os.path.basename(self.name))
+
+    def _check_shards(self, directory: str, hashes_path: str, paths: list[str]):
+        """
+        Raise BlockError if the previous build of another stack in directory
+        produced one of the shards, which the builds would overwrite and delete
+        in turn
+        """
+        shards = {os.path.normpath(path) for path in paths}
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.name == os.path.basename(hashes_path) or not (
+                entry.name.endswith(".metaform-hashes")
+            ):
+                continue
+            files = self._load_hashes(entry.path).get("files", {})
+            shared = sorted(shards.intersection(map(os.path.normpath, files)))
+            if shared:
+                raise BlockError(
+                    f"Files {', '.join(shared)} of {self.name} are also built by "
+                    f"the stack recorded in {entry.path}, build split stacks into "
+                    "directories of their own."
+                )
+
+    def _render_split(
+        self,
+        directory: str,
+        shards: dict[str, list[Block]],
+        stats: Optional[BuildStats],
+        format: str,
+        record: Callable[[Block, str], None],
+    ) -> dict[str, str]:
+        """
+        Render each shard of the blocks on a thread pool, returning the content of
+        {shard}.tf in directory by path
+        """
+
+        def render_shard(shard: tuple[str, list[Block]]) -> tuple[str, str]:
+            name, blocks = shard
+            path = os.path.join(directory, name + self._FORMAT_SUFFIXES[format])
+            return path, "".join(self._render(blocks, None, format, record))
+
+        with phase(stats, "render"), ThreadPoolExecutor() as pool:
+            return dict(pool.map(render_shard, shards.items()))
+
+    def _write_split(self, contents: dict[str, str], stats: Optional[BuildStats]):
+        """
+        Atomically write the shards, leaving those whose content is unchanged alone
+        """
+        with phase(stats, "write"), ThreadPoolExecutor() as pool:
+            list(pool.map(write_if_changed, contents, contents.values()))
+        if stats is not None:
+            stats.files.update(
+                (path, len(content.encode())) for path, content in contents.items()
+            )
+
+
+def _build_stack(
+    stack: Union[MetaFormer, Callable[[], MetaFormer]], kwargs: dict
+) -> BuildResult:
+    if not isinstance(stack, MetaFormer):
+        stack = stack()
+    return stack.build(**kwargs)
+
+
+def build_many(
+    stacks: Iterable[Union[MetaFormer, Callable[[], MetaFormer]]],
+    workers: Optional[int] = None,
+    processes: bool = False,
+    **kwargs,
+) -> list[BuildResult]:
+    """
+    Build independent stacks concurrently on a pool of workers and return their
+    BuildResults in order, passing kwargs to every build. Stacks are MetaFormers,
+    or functions creating one, built on threads. Rendering holds the GIL, so
+    processes=True builds on a process pool instead, which scales with cores;
+    the stacks must then be picklable functions, e.g. defined at module level,
+    creating their MetaFormer in the worker. Either way the builds belong to the
+    caller's build_session()
+    """
+    stacks = list(stacks)
+    if not processes:
+        # every build runs in a copy of the caller's context to see its session
+        contexts = [contextvars.copy_context() for _ in stacks]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(
+                pool.map(
+                    contextvars.Context.run,
+                    contexts,
+                    [_build_stack] * len(stacks),
+                    stacks,
+                    [kwargs] * len(stacks),
+                )
+            )
+    if any(isinstance(stack, MetaFormer) for stack in stacks):
+        raise TypeError(
+            "build_many with processes=True takes functions creating each stack, "
+            "not MetaFormer instances."
+        )
+    session = _session.get()
+    if session is not None:
+        kwargs = {"stats": session.stats, "graph": session.graph, **kwargs}
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for result in pool.map(_build_stack, stacks, [kwargs] * len(stacks)):
+            results.append(result)
+            if session is not None:
+                session.record(result)
+    return results
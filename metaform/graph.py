@@ -0,0 +1,171 @@
+from metaform.blocks import _PROPERTY
+from typing import TYPE_CHECKING, Iterable, Iterator, Optional
+import heapq
+import json
+
+if TYPE_CHECKING:
+    from metaform.compose import Registry
+
+
+HOTSPOTS = 10  # blocks listed per fan-in and fan-out ranking
+
+
+class DependencyGraph:
+    """
+    Dependency graph of the blocks of a registry, edges pointing from a block to
+    the blocks it depends on, with the metrics that bound how much of it
+    terraform can apply in parallel. Everything is derived in one pass over the
+    registry's maintained layers and dependency index
+    """
+
+    def __init__(
+        self,
+        registry: "Registry",
+        block_ids: Optional[Iterable[str]] = None,
+        name: str = "main",
+        hotspots: int = HOTSPOTS,
+    ):
+        self.name = name
+        self.nodes = {}  # block id -> group, in registration order
+        self.levels = {}
+        for block_id, group in registry.groups(block_ids):
+            if group == _PROPERTY:
+                continue
+            level = registry.levels.get(block_id)
+            if level is None:
+                raise registry.unresolved(block_id)
+            self.nodes[block_id] = group
+            self.levels[block_id] = level
+        self.edges = [
+            (block_id, dep_id)
+            for block_id in self.nodes
+            for dep_id in sorted(registry.depends_on.get(block_id, ()))
+            if dep_id in self.nodes
+        ]
+        self.fan_in = dict.fromkeys(self.nodes, 0)
+        self.fan_out = dict.fromkeys(self.nodes, 0)
+        for block_id, dep_id in self.edges:
+            self.fan_out[block_id] += 1
+            self.fan_in[dep_id] += 1
+
+        self.layers = []  # number of blocks in each dependency layer
+        for level in self.levels.values():
+            while len(self.layers) <= level:
+                self.layers.append(0)
+            self.layers[level] += 1
+        self.critical_path = self._critical_path(registry)
+        self.hotspots = {
+            "fan_in": self._hotspots(self.fan_in, hotspots),
+            "fan_out": self._hotspots(self.fan_out, hotspots),
+        }
+
+    def _critical_path(self, registry: "Registry") -> list[str]:
+        """
+        Returns a longest chain of dependencies, from a block in the last layer
+        down to the first. Layers are longest-path depths, so every block has a
+        dependency exactly one layer below it
+        """
+        if not self.layers:
+            return []
+        last = len(self.layers) - 1
+        block_id = next(b for b, level in self.levels.items() if level == last)
+        path = [block_id]
+        for level in range(last - 1, -1, -1):
+            block_id = min(
+                dep_id
+                for dep_id in registry.depends_on[block_id]
+                if self.levels.get(dep_id) == level
+            )
+            path.append(block_id)
+        return path
+
+    def _hotspots(self, degrees: dict[str, int], count: int) -> list[tuple[str, int]]:
+        return [
+            (block_id, degree)
+            for block_id, degree in heapq.nlargest(
+                count, degrees.items(), key=lambda item: item[1]
+            )
+            if degree
+        ]
+
+    def metrics(self) -> dict:
+        return {
+            "blocks": len(self.nodes),
+            "edges": len(self.edges),
+            "layers": list(self.layers),
+            "widest_layer": max(self.layers, default=0),
+            "critical_path_length": len(self.critical_path),
+            "critical_path": list(self.critical_path),
+            "average_parallelism": (
+                round(len(self.nodes) / len(self.layers), 2) if self.layers else 0.0
+            ),
+            "fan_in": [list(item) for item in self.hotspots["fan_in"]],
+            "fan_out": [list(item) for item in self.hotspots["fan_out"]],
+        }
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "nodes": [
+                {
+                    "id": block_id,
+                    "group": group,
+                    "layer": self.levels[block_id],
+                    "fan_in": self.fan_in[block_id],
+                    "fan_out": self.fan_out[block_id],
+                }
+                for block_id, group in self.nodes.items()
+            ],
+            "edges": [list(edge) for edge in self.edges],
+            "metrics": self.metrics(),
+        }
+
+    def iter_json(self) -> Iterator[str]:
+        """
+        Yield the as_dict() document with one node or edge per line, each encoded
+        compactly since indenting would leave the fast C encoder
+        """
+        graph = self.as_dict()
+        yield f'{{"name": {json.dumps(graph["name"])},\n'
+        yield f' "metrics": {json.dumps(graph["metrics"])},\n'
+        for key in ("nodes", "edges"):
+            yield f' "{key}": ['
+            yield ",".join(f"\n  {json.dumps(item)}" for item in graph[key])
+            yield "\n ]" + (",\n" if key == "nodes" else "\n")
+        yield "}\n"
+
+    def iter_dot(self) -> Iterator[str]:
+        """
+        Yield a Graphviz digraph with one rank per dependency layer and the
+        critical path drawn in red
+        """
+        metrics = self.metrics()
+        label = (
+            f"{self.name}: {metrics['blocks']} blocks, "
+            f"{len(self.layers)} layers (widest {metrics['widest_layer']}), "
+            f"average parallelism {metrics['average_parallelism']}"
+        )
+        yield f"digraph {json.dumps(self.name)} {{\n"
+        yield f"  label={json.dumps(label)};\n"
+        yield "  rankdir=BT;\n  node [shape=box];\n"
+        critical = set(self.critical_path)
+        by_layer = [[] for _ in self.layers]
+        for block_id in self.nodes:
+            by_layer[self.levels[block_id]].append(block_id)
+        for level, block_ids in enumerate(by_layer):
+            yield f"  subgraph layer_{level} {{\n    rank=same;\n"
+            for block_id in block_ids:
+                style = ", color=red" if block_id in critical else ""
+                yield f"    {json.dumps(block_id)} [group={self.nodes[block_id]}{style}];\n"
+            yield "  }\n"
+        critical_edges = set(zip(self.critical_path, self.critical_path[1:]))
+        for edge in self.edges:
+            style = " [color=red]" if edge in critical_edges else ""
+            yield f"  {json.dumps(edge[0])} -> {json.dumps(edge[1])}{style};\n"
+        yield "}\n"
+
+    def to_dot(self) -> str:
+        return "".join(self.iter_dot())
+
+    def to_json(self) -> str:
+        return "".join(self.iter_json())
@@ -0,0 +1,217 @@
+from metaform.blocks import Block, BlockError, Caller, Interpolated, _NO_DEPENDENCIES
+from metaform.compose import Registry
+from typing import Any, Callable, Iterable, Optional
+import gc
+import marshal
+import mmap
+import struct
+
+
+MAGIC = b"MFSNAP"
+SNAPSHOT_VERSION = 1
+_HEADER = struct.Struct("<HQ")  # snapshot version, index length
+_MARSHAL_VERSION = 4
+
+
+class SnapshotError(Exception):
+    """
+    Exception to return due to unreadable or incompatible registry snapshots
+    """
+
+
+class _Encoder:
+    """
+    Turns blocks into marshal-able records. Registered blocks are referenced by
+    their position in the registry and every other block is stored inline
+    """
+
+    def __init__(self, registry: Registry):
+        self.indices = {block_id: index for index, block_id in enumerate(registry)}
+        self.refs = set()
+
+    def header(self, block: Block) -> tuple:
+        return (
+            block._group,
+            block.group,
+            block.group_abbrv,
+            block.ids,
+            block._key,
+            block.invisible_map,
+            block.tomap,
+        )
+
+    def record(self, block: Block) -> tuple:
+        return (
+            *self.header(block),
+            tuple((k, self.value(v)) for k, v in block.properties.items()),
+            tuple(map(self.reference, block.dependencies)),
+        )
+
+    def reference(self, block: Block) -> tuple:
+        """
+        Encodes a block that is only referred to, as a dependency or the base of
+        a Caller, rather than embedded
+        """
+        return self.block(block)
+
+    def block(self, block: Block) -> tuple:
+        index = self.indices.get(block._key)
+        if index is not None:
+            self.refs.add(index)
+            return ("r", index)
+        return ("b", self.record(block))
+
+    def value(self, v: Any) -> Any:
+        if isinstance(v, Block):
+            return self.block(v)
+        elif isinstance(v, Caller):
+            if isinstance(v.base, Block):
+                return ("c", self.reference(v.base), v.call)
+            return ("c", self.value(v.base), v.call)
+        elif isinstance(v, Interpolated):
+            return ("i", v.template)
+        elif isinstance(v, dict):
+            return ("d", tuple((k, self.value(_v)) for k, _v in v.items()))
+        elif isinstance(v, list):
+            return ("l", tuple(map(self.value, v)))
+        elif isinstance(v, tuple):
+            return ("t", tuple(map(self.value, v)))
+        elif v is None or type(v) in (str, int, float, bool):
+            return v
+        elif isinstance(v, str):
+            return str.__str__(v)  # subclasses render as their plain value
+        elif isinstance(v, float):
+            return float(v)
+        elif isinstance(v, int):
+            return int(v)
+        return str(v)
+
+
+class _Decoder:
+    """
+    Rebuilds blocks from their records, creating registered blocks as shells on
+    first reference so that forward references and cycles resolve
+    """
+
+    _BLOCK_TAGS = ("r", "b")
+
+    def __init__(self, records: Callable[[int], tuple]):
+        self.records = records
+        self.blocks = {}
+
+    def shell(self, record: tuple) -> Block:
+        return Block._assemble(*record[:4], *record[5:7])
+
+    def registered(self, index: int, record: Optional[tuple] = None) -> Block:
+        block = self.blocks.get(index)
+        if block is None:
+            record = record or self.records(index)
+            block = self.blocks[index] = self.shell(record)
+        return block
+
+    def fill(self, block: Block, record: tuple) -> Block:
+        properties = {k: self.value(v, block) for k, v in record[7]}
+        dict.update(block._properties, properties)
+        block.dependencies = set(map(self.block, record[8])) or _NO_DEPENDENCIES
+        return block
+
+    def block(self, encoded: tuple) -> Block:
+        if encoded[0] == "r":
+            return self.registered(encoded[1])
+        return self.fill(self.shell(encoded[1]), encoded[1])
+
+    def value(self, v: Any, parent: Optional[Block] = None) -> Any:
+        if not isinstance(v, tuple):
+            return v
+        tag = v[0]
+        if tag in self._BLOCK_TAGS:
+            block = self.block(v)
+            if parent is not None:
+                block._add_parent(parent)
+            return block
+        elif tag == "c":
+            return Caller(self.value(v[1]), v[2])
+        elif tag == "i":
+            return Interpolated(v[1])
+        elif tag == "d":
+            return {k: self.value(_v, parent) for k, _v in v[1]}
+        elif tag == "l":
+            return [self.value(_v, parent) for _v in v[1]]
+        return tuple(self.value(_v, parent) for _v in v[1])
+
+
+def save_registry(registry: Registry, path: str):
+    """
+    Write the blocks of a registry, their properties and dependency edges to a
+    versioned binary snapshot at path
+    """
+    encoder = _Encoder(registry)
+    records = []
+    refs = []
+    for block in registry.values():
+        encoder.refs = set()
+        records.append(marshal.dumps(encoder.record(block), _MARSHAL_VERSION))
+        refs.append(tuple(sorted(encoder.refs)))
+    offsets = [0]
+    for record in records:
+        offsets.append(offsets[-1] + len(record))
+    index = marshal.dumps(
+        (tuple(registry), tuple(refs), tuple(offsets)), _MARSHAL_VERSION
+    )
+    with open(path, "wb") as f:
+        f.write(MAGIC + _HEADER.pack(SNAPSHOT_VERSION, len(index)))
+        f.write(index)
+        f.writelines(records)
+
+
+def load_registry(path: str, block_ids: Optional[Iterable[str]] = None) -> Registry:
+    """
+    Load a registry saved with save_registry. The snapshot is memory-mapped and
+    with block_ids only those blocks and the blocks they reference are decoded
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        header_end = len(MAGIC) + _HEADER.size
+        if m[: len(MAGIC)] != MAGIC:
+            raise SnapshotError(f"{path} is not a metaform registry snapshot.")
+        version, index_length = _HEADER.unpack(m[len(MAGIC) : header_end])
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError(
+                f"{path} is a version {version} snapshot, but version "
+                f"{SNAPSHOT_VERSION} is required."
+            )
+        keys, refs, offsets = marshal.loads(m[header_end : header_end + index_length])
+        data = header_end + index_length
+
+        def records(index: int) -> tuple:
+            return marshal.loads(m[data + offsets[index] : data + offsets[index + 1]])
+
+        if block_ids is None:
+            selected = range(len(keys))
+        else:
+            positions = {block_id: index for index, block_id in enumerate(keys)}
+            stack = []
+            for block_id in map(str, block_ids):
+                if block_id not in positions:
+                    raise BlockError(f"Block {block_id} is not in snapshot {path}.")
+                stack.append(positions[block_id])
+            seen = set()
+            while stack:
+                index = stack.pop()
+                if index not in seen:
+                    seen.add(index)
+                    stack.extend(refs[index])
+            selected = sorted(seen)
+
+        decoder = _Decoder(records)
+        registry = Registry()
+        gc_enabled = gc.isenabled()
+        gc.disable()  # decoding only allocates, collecting would rescan every block
+        try:
+            for index in selected:
+                record = records(index)
+                block = decoder.registered(index, record)
+                registry[keys[index]] = decoder.fill(block, record)
+        finally:
+            if gc_enabled:
+                gc.enable()
+    return registry
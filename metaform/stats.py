@@ -0,0 +1,61 @@
+from contextlib import contextmanager, nullcontext
+from typing import ContextManager, Iterator, Optional
+import time
+
+
+class BuildStats:
+    """
+    Phase timings and counts recorded while building a MetaFormer registry
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.phases = {}
+        self.blocks = {}
+        self.layers = 0
+        self.widest_layer = 0
+        self.files = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "phases": dict(self.phases),
+            "blocks": dict(self.blocks),
+            "layers": self.layers,
+            "widest_layer": self.widest_layer,
+            "files": dict(self.files),
+        }
+
+    def summary(self) -> str:
+        return summarize(self.as_dict())
+
+
+def summarize(stats: dict) -> str:
+    """
+    One line describing a build from its stats dict
+    """
+    phases = " ".join(
+        f"{phase}={seconds * 1000:.1f}ms" for phase, seconds in stats["phases"].items()
+    )
+    return (
+        f"{stats['name']}: {sum(stats['blocks'].values())} blocks, "
+        f"{stats['layers']} layers (widest {stats['widest_layer']}), "
+        f"{sum(stats['files'].values())} bytes in {len(stats['files'])} files, "
+        f"{phases}"
+    )
+
+
+def phase(stats: Optional[BuildStats], name: str) -> ContextManager:
+    """
+    Time a phase when stats are being recorded, otherwise do nothing
+    """
+    return stats.phase(name) if stats is not None else nullcontext()
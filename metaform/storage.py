@@ -0,0 +1,392 @@
+from metaform.blocks import Block
+from metaform.compose import Registry
+from metaform import snapshot
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Iterable, Iterator, Optional
+import itertools
+import marshal
+import sqlite3
+import sys
+import weakref
+
+
+STORAGE_VERSION = 2
+_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS blocks (
+        id TEXT PRIMARY KEY,
+        position INTEGER NOT NULL,
+        block_group TEXT NOT NULL,
+        dependencies BLOB NOT NULL,
+        record BLOB NOT NULL
+    ) WITHOUT ROWID
+    """,
+    # the blocks whose records hold a copy of each nested block
+    "CREATE TABLE IF NOT EXISTS embeds (nested INTEGER NOT NULL, parent TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS embeds_nested ON embeds (nested)",
+    "CREATE INDEX IF NOT EXISTS embeds_parent ON embeds (parent)",
+)
+
+
+class StorageError(Exception):
+    """
+    Exception to return due to unreadable or incompatible registry databases
+    """
+
+
+class _Encoder(snapshot._Encoder):
+    """
+    Turns blocks into database records. Registered blocks embedded in a block
+    are stored by id and paged in with it. Other embedded blocks are stored
+    inline under a key identifying the block, so that a block nested in several
+    others decodes to one block while it is in memory. Blocks it only refers to
+    are stored as their header and decoded as empty blocks, which render the
+    same references
+    """
+
+    def __init__(self, registry: "SQLiteRegistry"):
+        self.registry = registry
+        self.nested = []  # keys of the nested blocks in the record
+
+    def block(self, block: Block) -> tuple:
+        if self.registry._current(block._key) is block:
+            return ("r", block._key)
+        key = self.registry._nested_key(block)
+        self.nested.append(key)
+        return ("n", (key, self.record(block)))
+
+    def reference(self, block: Block) -> tuple:
+        return ("s", self.header(block))
+
+
+class _Decoder(snapshot._Decoder):
+    _BLOCK_TAGS = ("r", "b", "s", "n")
+
+    def __init__(self, registry: "SQLiteRegistry"):
+        self.registry = registry
+        self.references = {}
+
+    def block(self, encoded: tuple) -> Block:
+        tag, v = encoded
+        if tag == "r":
+            return self.registry[v]
+        elif tag == "n":
+            key, record = v
+            block = self.registry._nested_block(key)
+            if block is None:
+                block = self.shell(record)
+                self.registry._track_nested(block, key)
+                self.fill(block, record)
+            return block
+        elif tag == "s":
+            block = self.references.get(v[4])
+            if block is None:
+                block = self.registry._current(v[4]) or self.shell(v)
+                self.references[v[4]] = block
+            return block
+        return self.fill(self.shell(v), v)
+
+
+class _GroupBlocks(MutableMapping):
+    """
+    The blocks of one group, read through the registry instead of being held
+    by the Group that created them
+    """
+
+    def __init__(self, registry: "SQLiteRegistry", group: str):
+        self.registry = registry
+        self.group = group
+
+    def __getitem__(self, block_id: str) -> Block:
+        if block_id in self.registry:
+            _, group = next(self.registry.groups([block_id]))
+            if group == self.group:
+                return self.registry[block_id]
+        raise KeyError(block_id)
+
+    def __setitem__(self, block_id: str, block: Block):
+        pass  # the registry keeps every block it registers
+
+    def __delitem__(self, block_id: str):
+        raise KeyError(block_id)
+
+    def __iter__(self) -> Iterator[str]:
+        return (
+            block_id
+            for block_id, group in self.registry.groups()
+            if group == self.group
+        )
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class SQLiteRegistry(Registry):
+    """
+    Registry keeping its blocks in a SQLite database at path instead of memory,
+    for configurations with more blocks than fit in it. Up to cache_size
+    recently used blocks stay in memory, the others are decoded again when used,
+    while ids, layers and dependencies remain indexed in memory. Blocks are
+    written when registered and again when paged out after changing, and
+    committed by flush(), which every build calls. Opening an existing database
+    registers its blocks
+    """
+
+    def __init__(self, path: str, cache_size: int = 10000):
+        if cache_size < 1:
+            raise ValueError("SQLiteRegistry needs a cache_size of at least 1.")
+        super(SQLiteRegistry, self).__init__()
+        self.path = path
+        self.cache_size = cache_size
+        self.resident = (
+            OrderedDict()
+        )  # ids of blocks in memory -> changed since written
+        self.live = weakref.WeakValueDictionary()  # paged out but still referenced
+        # weak references to the nested blocks in records, by id() and by key
+        self.nested = {}
+        self.nested_refs = {}
+        self.nested_changed = {}  # key -> nested block changed since written
+        self.revived = []  # parents paged in to follow a nested block's change
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        try:
+            version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        except sqlite3.DatabaseError as error:
+            raise StorageError(
+                f"{path} is not a metaform registry database."
+            ) from error
+        if version not in (0, 1, STORAGE_VERSION):  # 1 has no nested block keys
+            raise StorageError(
+                f"{path} is a version {version} registry database, but version "
+                f"{STORAGE_VERSION} is required."
+            )
+        self.connection.execute(f"PRAGMA user_version = {STORAGE_VERSION}")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        for statement in _SCHEMA:
+            self.connection.execute(statement)
+        (last_key,) = self.connection.execute(
+            "SELECT MAX(nested) FROM embeds"
+        ).fetchone()
+        self.nested_keys = itertools.count((last_key or 0) + 1)
+        for block_id, group, dependencies in self.connection.execute(
+            "SELECT id, block_group, dependencies FROM blocks ORDER BY position"
+        ):
+            block_id = sys.intern(block_id)
+            dict.__setitem__(self, block_id, sys.intern(group))
+            self.positions[block_id] = len(self.positions)
+            self._reindex(block_id, set(marshal.loads(dependencies)))
+
+    def __setitem__(self, block_id: str, block: Block):
+        with self.lock:
+            new = block_id not in self
+            super(SQLiteRegistry, self).__setitem__(block_id, block)
+            if isinstance(block, Block):
+                self.live.pop(block_id, None)
+                self._write([block], new)
+                self._admit(block_id, False)
+                for parent in list((block._parents or {}).values()):
+                    # written with a copy of the block, now stored by id
+                    if self._current(parent._key) is parent:
+                        self._changed(parent)
+        return self
+
+    def __delitem__(self, block_id: str):
+        with self.lock:
+            super(SQLiteRegistry, self).__delitem__(block_id)
+            self.resident.pop(block_id, None)
+            self.live.pop(block_id, None)
+            self.connection.execute("DELETE FROM blocks WHERE id = ?", (block_id,))
+            self.connection.execute("DELETE FROM embeds WHERE parent = ?", (block_id,))
+
+    def __getitem__(self, block_id: str) -> Block:
+        with self.lock:
+            block = dict.get(self, block_id)
+            if block is None:
+                return super(SQLiteRegistry, self).__getitem__(block_id)  # raises
+            elif isinstance(block, Block):
+                self.resident.move_to_end(block_id)
+                return block
+            return self._page_in(block_id)
+
+    def get(self, block_id: str, default: Optional[Block] = None) -> Optional[Block]:
+        return self[block_id] if block_id in self else default
+
+    def values(self) -> Iterator[Block]:
+        return self.blocks_of(list(self.keys()))
+
+    def items(self) -> Iterator[tuple[str, Block]]:
+        block_ids = list(self.keys())
+        return zip(block_ids, self.blocks_of(block_ids))
+
+    def blocks_of(self, block_ids: Iterable[str]) -> Iterator[Block]:
+        return map(self.__getitem__, block_ids)
+
+    def groups(
+        self, block_ids: Optional[Iterable[str]] = None
+    ) -> Iterator[tuple[str, str]]:
+        if block_ids is None:
+            entries = dict.items(self)
+        else:
+            get = dict.__getitem__
+            entries = ((block_id, get(self, block_id)) for block_id in block_ids)
+        return (
+            (block_id, v if isinstance(v, str) else v._group) for block_id, v in entries
+        )
+
+    def _tracking(self, group: str) -> MutableMapping:
+        return _GroupBlocks(self, group)
+
+    def _block_changed(self, block: Block, dependencies: set[Block]):
+        with self.lock:
+            if self._current(block._key) is block:
+                self._changed(block)
+            else:
+                key = self._nested_key(block, create=False)
+                if key is not None:
+                    self.nested_changed[key] = block
+                    if dependencies != block.dependencies:
+                        self.revived.extend(self._parents_of(key))
+            super(SQLiteRegistry, self)._block_changed(block, dependencies)
+
+    def _parents_of(self, key: int) -> Iterator[Block]:
+        """
+        Page in the registered blocks holding a copy of a nested block. They
+        decode to the nested block itself while it is in memory, so they are
+        invalidated with it
+        """
+        parents = self.connection.execute(
+            "SELECT parent FROM embeds WHERE nested = ?", (key,)
+        ).fetchall()
+        return (self[parent] for (parent,) in parents if parent in self)
+
+    def _nested_key(self, block: Block, create: bool = True) -> Optional[int]:
+        ref = self.nested.get(id(block))
+        if ref is not None and ref() is block:
+            return ref.key[1]
+        elif create:
+            key = next(self.nested_keys)
+            self._track_nested(block, key)
+            return key
+        return None
+
+    def _nested_block(self, key: int) -> Optional[Block]:
+        ref = self.nested_refs.get(key)
+        return None if ref is None else ref()
+
+    def _track_nested(self, block: Block, key: int):
+        ref = weakref.KeyedRef(block, self._forget_nested, (id(block), key))
+        self.nested[id(block)] = self.nested_refs[key] = ref
+        block._registry = self  # to hear about its changes
+
+    def _forget_nested(self, ref: weakref.KeyedRef):
+        block_id, key = ref.key
+        if self.nested.get(block_id) is ref:
+            del self.nested[block_id]
+        if self.nested_refs.get(key) is ref:
+            del self.nested_refs[key]
+
+    def _changed(self, block: Block):
+        """
+        Keep a changed block in memory until it is written again
+        """
+        dict.__setitem__(self, block._key, block)
+        self.live.pop(block._key, None)
+        self._admit(block._key, True)
+
+    def _current(self, block_id: str) -> Optional[Block]:
+        """
+        Returns the registered block object for block_id if it is in memory
+        """
+        block = dict.get(self, block_id)
+        if isinstance(block, Block):
+            return block
+        return self.live.get(block_id)
+
+    def _admit(self, block_id: str, changed: bool):
+        """
+        Mark a block as the most recently used, paging out the least recently
+        used blocks past cache_size
+        """
+        resident = self.resident
+        resident[block_id] = resident.get(block_id, False) or changed
+        resident.move_to_end(block_id)
+        while len(resident) > self.cache_size:
+            block_id, changed = resident.popitem(last=False)
+            block = dict.__getitem__(self, block_id)
+            if changed:
+                self._write([block])
+            dict.__setitem__(self, block_id, block._group)
+            self.live[block_id] = block
+
+    def _page_in(self, block_id: str) -> Block:
+        block = self.live.pop(block_id, None)
+        if block is None:
+            (data,) = self.connection.execute(
+                "SELECT record FROM blocks WHERE id = ?", (block_id,)
+            ).fetchone()
+            record = marshal.loads(data)
+            decoder = _Decoder(self)
+            block = decoder.fill(decoder.shell(record), record)
+            block._registry = self
+        dict.__setitem__(self, block_id, block)
+        self._admit(block_id, False)
+        return block
+
+    def _write(self, blocks: Iterable[Block], new: bool = False):
+        """
+        Write the records of blocks and which nested blocks they hold, where new
+        blocks have none recorded yet
+        """
+        encoder = _Encoder(self)
+        rows = []
+        embeds = []
+        for block in blocks:
+            encoder.nested = []
+            rows.append(
+                (
+                    block._key,
+                    self.positions[block._key],
+                    block._group,
+                    marshal.dumps(
+                        tuple(sorted(self.depends_on.get(block._key, ()))),
+                        snapshot._MARSHAL_VERSION,
+                    ),
+                    marshal.dumps(encoder.record(block), snapshot._MARSHAL_VERSION),
+                )
+            )
+            embeds.extend((key, block._key) for key in set(encoder.nested))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?)", rows
+        )
+        if not new:
+            self.connection.executemany(
+                "DELETE FROM embeds WHERE parent = ?", ((row[0],) for row in rows)
+            )
+        if embeds:
+            self.connection.executemany("INSERT INTO embeds VALUES (?, ?)", embeds)
+
+    def flush(self):
+        """
+        Write the blocks changed since they were last written and commit them
+        """
+        with self.lock:
+            for key in self.nested_changed:  # rewrite the copies in their parents
+                for parent in self._parents_of(key):
+                    self._changed(parent)
+            changed = [block_id for block_id, c in self.resident.items() if c]
+            self._write(dict.__getitem__(self, block_id) for block_id in changed)
+            for block_id in changed:
+                self.resident[block_id] = False
+            self.nested_changed.clear()
+            del self.revived[:]
+            self.connection.commit()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def __enter__(self) -> "SQLiteRegistry":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
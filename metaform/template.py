@@ -0,0 +1,273 @@
+from metaform.blocks import Block, BlockError, Caller, Interpolated, _DEPENDENCY_GROUPS
+from metaform.compose import Registry
+from typing import TYPE_CHECKING, Any, Callable
+import inspect
+import math
+import re
+
+if TYPE_CHECKING:
+    from metaform.compose import MetaFormer
+
+
+_MARKER = re.compile("\x00([A-Za-z_][A-Za-z0-9_]*)\x00")
+
+
+def _marker(param: str) -> str:
+    return f"\x00{param}\x00"
+
+
+class _Parameter:
+    """
+    Stands in for a template parameter while fn is recorded. It can be used as a
+    property value, referenced with parameter["attribute"], formatted into ids and
+    strings or concatenated with strings, anything depending on its value raises
+    """
+
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __str__(self) -> str:
+        return _marker(self.name)
+
+    def __format__(self, spec: str) -> str:
+        if spec:
+            self._unknown(f"format spec {spec!r}")
+        return _marker(self.name)
+
+    def __repr__(self) -> str:
+        return f"<template parameter {self.name}>"
+
+    def __getitem__(self, call: str) -> Caller:
+        return Caller(self, call)
+
+    def __add__(self, other: Any) -> str:
+        if not isinstance(other, str):
+            self._unknown("+")
+        return _marker(self.name) + other
+
+    def __radd__(self, other: Any) -> str:
+        if not isinstance(other, str):
+            self._unknown("+")
+        return other + _marker(self.name)
+
+    def _unknown(self, operation: str, *args: Any):
+        raise BlockError(
+            f"Template parameter {self.name} has no value while the template is "
+            f"recorded, so it can not be used with {operation}. Use it as a "
+            "property value or format it into ids and strings."
+        )
+
+    def _operation(operation: str) -> Callable[..., Any]:
+        return lambda self, *args: self._unknown(operation)
+
+    __bool__ = _operation("bool() or if")
+    __len__ = _operation("len()")
+    __iter__ = _operation("iteration")
+    __contains__ = _operation("in")
+    __int__ = __index__ = _operation("int()")
+    __float__ = _operation("float()")
+    __eq__ = __ne__ = _operation("== or !=")
+    __lt__ = __le__ = __gt__ = __ge__ = _operation("<, <=, > or >=")
+    __neg__ = __pos__ = __abs__ = __invert__ = _operation("unary operators")
+    __sub__ = __rsub__ = __mul__ = __rmul__ = _operation("arithmetic")
+    __truediv__ = __rtruediv__ = __floordiv__ = _operation("arithmetic")
+    __rfloordiv__ = __mod__ = __rmod__ = __pow__ = __rpow__ = _operation("arithmetic")
+    __and__ = __rand__ = __or__ = __ror__ = __xor__ = _operation("bitwise operators")
+    __hash__ = object.__hash__
+    del _operation
+
+
+class Template:
+    """
+    Blocks defined by fn(tf, **params), recorded once with placeholder
+    parameters and compiled into a function stamping a copy of them for new
+    parameters. Parameters may be used as property values or formatted into ids
+    and strings, blocks from outside the template are shared by every copy
+    """
+
+    def __init__(self, tf: "MetaFormer", fn: Callable[..., Any]):
+        self.tf = tf
+        self.params = list(inspect.signature(fn).parameters)[1:]
+        recorder = type(tf)(tf.name, registry=Registry())
+        returned = fn(recorder, **{param: _Parameter(param) for param in self.params})
+        if recorder.provider.blocks:
+            raise BlockError("Templates can not add providers.")
+        blocks = list(recorder.registry.values())
+        groups = [getattr(tf, block._group) for block in blocks]
+        self.groups = [group.blocks for group in groups]
+        self.ignore_duplicates = [group._ignore_duplicates for group in groups]
+        compiler = _Compiler(tf, blocks)
+        self.source = compiler.compile(returned)
+        namespace = {
+            "assemble": Block._assemble,
+            "Caller": Caller,
+            "Interpolated": Interpolated,
+            "update": dict.update,
+            **{f"s{index}": v for index, v in enumerate(compiler.shared)},
+        }
+        exec(compile(self.source, f"<template {fn.__name__}>", "exec"), namespace)
+        self._stamp = namespace["stamp"]
+
+    def __call__(self, **params: Any) -> Any:
+        """
+        Stamp a copy of the template's blocks into the MetaFormer and return what
+        fn returned, with its blocks replaced by their copies
+        """
+        if params.keys() != set(self.params):
+            raise TypeError(
+                f"Template takes parameters {', '.join(self.params)}, "
+                f"but got {', '.join(params)}"
+            )
+        blocks, returned = self._stamp(params)
+        registry = self.tf.registry
+        with registry.lock:
+            duplicates = [
+                block._key
+                for block, ignore in zip(blocks, self.ignore_duplicates)
+                if not ignore and block._key in registry
+            ]
+            if duplicates:
+                raise BlockError(
+                    f"Blocks {', '.join(duplicates)} are already registered in the block registry."
+                )
+            for block, group in zip(blocks, self.groups):
+                registry[block._key] = group[block._key] = block
+        return returned
+
+
+class _Compiler:
+    """
+    Generates the source of stamp(p), which creates a copy of the recorded blocks
+    for the parameters p with their properties and dependencies written out, so
+    no ids are parsed and no dependencies rediscovered, except for blocks with
+    parameters as values, which may be references. Values that are the same for
+    every copy are shared through the globals s0, s1, ...
+    """
+
+    def __init__(self, tf: "MetaFormer", blocks: list[Block]):
+        self.tf = tf
+        self.blocks = blocks
+        self.names = {block._key: f"b{index}" for index, block in enumerate(blocks)}
+        self.shared = []
+        self.lines = []
+        self.parametric = False
+        self.dynamic = set()
+
+    def compile(self, returned: Any) -> str:
+        for block in self.blocks:
+            self.lines.append(f"{self.names[block._key]} = {self.shell(block)}")
+        for block in self.blocks:
+            self.fill(self.names[block._key], block)
+        blocks = "".join(f"{self.names[block._key]}, " for block in self.blocks)
+        self.lines.append(f"return [{blocks}], {self.expr(returned, [])}")
+        return "def stamp(p):\n" + "".join(f"    {line}\n" for line in self.lines)
+
+    def share(self, v: Any) -> str:
+        self.shared.append(v)
+        return f"s{len(self.shared) - 1}"
+
+    def string(self, s: str) -> str:
+        if "\x00" not in s:
+            return repr(s)
+        parts = _MARKER.split(s)
+        return " + ".join(
+            f"str(p[{part!r}])" if index % 2 else repr(part)
+            for index, part in enumerate(parts)
+            if part or index % 2
+        )
+
+    def shell(self, block: Block) -> str:
+        header = (block._group, block.group, block.group_abbrv)
+        if any("\x00" in s for s in header):
+            raise BlockError(
+                f"Template parameters can not be used as group of {block}."
+            )
+        ids = "".join(f"{self.string(s)}, " for s in block.ids)
+        return (
+            f"assemble({', '.join(map(repr, header))}, ({ids}), "
+            f"{block.invisible_map!r}, {block.tomap!r})"
+        )
+
+    def key(self, k: Any) -> str:
+        if isinstance(k, _Parameter):
+            return f"str(p[{k.name!r}])"
+        return self.string(k)
+
+    def fill(self, name: str, block: Block):
+        """
+        Writes the properties and dependencies of the block name. Dependencies of
+        blocks with parameters as values, directly or through embedded blocks,
+        are found when stamped
+        """
+        outer, self.parametric = self.parametric, False
+        embedded = []
+        properties = ", ".join(
+            f"{self.key(k)}: {self.expr(v, embedded)}"
+            for k, v in block.properties.items()
+        )
+        parametric, self.parametric = self.parametric, outer
+        self.lines.append(f"update({name}._properties, {{{properties}}})")
+        for embedded_name in embedded:
+            self.lines.append(f"{embedded_name}._add_parent({name})")
+        if parametric or self.dynamic.intersection(embedded):
+            self.dynamic.add(name)
+            self.lines.append(
+                f"{name}.dependencies = {name}._find_dependencies() or frozenset()"
+            )
+            return
+        dependencies = ", ".join(self.expr(dep, []) for dep in block.dependencies)
+        self.lines.append(f"{name}.dependencies = {{{dependencies}}}")
+        if not dependencies:
+            self.lines[-1] = f"{name}.dependencies = frozenset()"
+
+    def is_shared(self, block: Block) -> bool:
+        """
+        Blocks outside the template are shared, except for nested blocks created
+        by fn, which are copied
+        """
+        return block._key not in self.names and (
+            block._group in _DEPENDENCY_GROUPS
+            or self.tf.registry.get(block._key) is block
+        )
+
+    def expr(self, v: Any, embedded: list[str]) -> str:
+        """
+        Returns the expression building v in stamp, adding the names of the
+        blocks it embeds outside of references to embedded
+        """
+        if isinstance(v, str):
+            return self.string(v)
+        elif isinstance(v, _Parameter):
+            self.parametric = True
+            return f"p[{v.name!r}]"
+        elif isinstance(v, Block):
+            if v._key in self.names:
+                name = self.names[v._key]
+            elif self.is_shared(v):
+                name = self.share(v)
+            else:
+                name = f"n{len(self.lines)}"
+                self.lines.append(f"{name} = {self.shell(v)}")
+                self.fill(name, v)
+            embedded.append(name)
+            return name
+        elif isinstance(v, Caller):
+            return f"Caller({self.expr(v.base, [])}, {v.call!r})"
+        elif isinstance(v, Interpolated):
+            return f"Interpolated({self.string(v.template)})"
+        elif isinstance(v, dict):
+            items = ", ".join(
+                f"{self.key(k)}: {self.expr(_v, embedded)}" for k, _v in v.items()
+            )
+            return f"{{{items}}}"
+        elif isinstance(v, list):
+            return f"[{', '.join(self.expr(_v, embedded) for _v in v)}]"
+        elif isinstance(v, tuple):
+            return f"({''.join(self.expr(_v, embedded) + ', ' for _v in v)})"
+        elif v is None or type(v) in (bool, int):
+            return repr(v)
+        elif type(v) is float and math.isfinite(v):
+            return repr(v)
+        return self.share(v)
@@ -0,0 +1,104 @@
+from metaform.blocks import Block, Caller, Interpolated, _escape_template
+from typing import Any, Callable, Iterable, Iterator, Mapping, Optional
+import json
+
+
+def _value(v: Any) -> Any:
+    """
+    Convert a property value to its Terraform JSON equivalent
+    """
+    if isinstance(v, Caller):
+        return "${" + str(v) + "}"
+    elif isinstance(v, Interpolated):
+        return v.template
+    elif isinstance(v, Block):
+        return block_body(v)
+    elif isinstance(v, dict):
+        return {str(k): _value(_v) for k, _v in v.items()}
+    elif isinstance(v, (list, tuple)):
+        return [_value(_v) for _v in v]
+    elif isinstance(v, str):
+        return _escape_template(v)
+    elif v is None or isinstance(v, (str, int, float, bool)):
+        return v
+    return str(v)
+
+
+def _nest(body: dict, path: list[str], value: Any):
+    """
+    Place value under body at the path of block type and labels, turning repeated
+    blocks of the same type into a list
+    """
+    *labels, last = path
+    for label in labels:
+        body = body.setdefault(label, {})
+    if last not in body:
+        body[last] = value
+    elif isinstance(body[last], list):
+        body[last].append(value)
+    else:
+        body[last] = [body[last], value]
+
+
+def block_body(block: Block) -> dict:
+    """
+    Returns the JSON object for the body of a block, nested blocks included
+    """
+    body = {}
+    for k, v in block.properties.items():
+        if isinstance(v, Block):
+            _nest(body, [v.group, *v.ids], block_body(v))
+        else:
+            body[k] = _value(v)
+    return body
+
+
+def _encode(
+    node: Any,
+    level: int,
+    record: Optional[Callable[[Block, str], None]],
+    registry: Optional[Mapping[str, Block]],
+) -> Iterator[str]:
+    if not isinstance(node, dict):
+        block = registry[node] if isinstance(node, str) else node
+        rendered = json.dumps(block_body(block), indent=2)
+        if record is not None:
+            record(block, rendered)
+        yield rendered.replace("\n", "\n" + "  " * level)
+        return
+    if not node:
+        yield "{}"
+        return
+    yield "{"
+    for index, (key, child) in enumerate(node.items()):
+        indent = "\n" + "  " * (level + 1)
+        yield ("," if index else "") + indent + json.dumps(key) + ": "
+        yield from _encode(child, level + 1, record, registry)
+    yield "\n" + "  " * level + "}"
+
+
+def iter_encode(
+    blocks: Iterable[Block],
+    record: Optional[Callable[[Block, str], None]] = None,
+    registry: Optional[Mapping[str, Block]] = None,
+) -> Iterator[str]:
+    """
+    Yield a Terraform JSON document for the blocks chunk by chunk. Only the
+    blocks are grouped up front, each body is rendered as it is written and
+    passed to record with its block. Blocks registered in registry are grouped
+    by id and looked up again when written, so a registry paging blocks out
+    does not have the document hold all of them
+    """
+    tree = {}
+    for block in blocks:
+        node = tree
+        *labels, last = [block.group, *block.ids]
+        for label in labels:
+            node = node.setdefault(label, {})
+        block_id = str(block)
+        if registry is not None and registry.get(block_id) is block:
+            node[last] = block_id
+        else:
+            node[last] = block
+    yield from _encode(tree, 0, record, registry)
+    yield "\n"
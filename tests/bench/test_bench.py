@@ -0,0 +1,39 @@
+import json
+
+
+def test_run_benchmarks(tmp_path, monkeypatch):
+    from metaform import bench, cli
+
+    results = bench.run_benchmarks(scale=0.001)
+    assert set(results["scenarios"]) == {"wide", "deep", "nested", "maps"}
+    for scenario in results["scenarios"].values():
+        assert list(scenario["phases"]) == [
+            "construct",
+            "resolve",
+            "collect",
+            "write",
+            "build",
+        ]
+        for phase in scenario["phases"].values():
+            assert phase["seconds"] >= 0 and phase["peak_bytes"] > 0
+    assert results["startup"]["mf"] >= results["startup"]["interpreter"] > 0
+
+    baseline = tmp_path / "baseline.json"
+    baseline.write_text(json.dumps(results))
+    output = tmp_path / "results.json"
+    monkeypatch.setattr(
+        "sys.argv",
+        [
+            "mf",
+            "bench",
+            "--scale=0.001",
+            "--scenario=deep",
+            "--no-memory",
+            f"--output={output}",
+            f"--compare={baseline}",
+        ],
+    )
+    assert cli.main() == 0
+    saved = json.loads(output.read_text())
+    assert list(saved["scenarios"]) == ["deep"]
+    assert "peak_bytes" not in saved["scenarios"]["deep"]["phases"]["build"]
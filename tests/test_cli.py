@@ -0,0 +1,139 @@
+import pytest
+
+
+_SCRIPT = """
+from metaform.compose import MetaFormer
+
+tf = MetaFormer(name="{name}")
+tf.resource("aws_s3_bucket", "{name}", bucket="{name}")
+tf.build()
+print("built {name}")
+"""
+
+
+@pytest.fixture(scope="function")
+def scripts(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ["b", "a", "c"]:
+        (tmp_path / name).mkdir()
+        (tmp_path / name / f"{name}.tf.py").write_text(_SCRIPT.format(name=name))
+    (tmp_path / "b" / "leak.tf.py").write_text("assert 'tf' not in globals()")
+    return tmp_path
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_find_and_generate_metaf_files(scripts, capsys, jobs):
+    from metaform import cli
+
+    results = cli.find_and_generate_metaf_files(".", jobs=jobs)
+    assert [result.path for result in results] == [
+        "a/a.tf.py",
+        "b/b.tf.py",
+        "b/leak.tf.py",
+        "c/c.tf.py",
+    ]
+    assert all(result.ok for result in results)
+    assert results[0].output == "built a\n"
+    assert sorted(path.name for path in scripts.glob("*.tf")) == [
+        "a.tf",
+        "b.tf",
+        "c.tf",
+    ]
+    assert capsys.readouterr().out.startswith("In file a/a.tf.py\nbuilt a\n  ok in ")
+
+
+def test_main_exit_code(scripts, monkeypatch):
+    from metaform import cli
+
+    monkeypatch.setattr("sys.argv", ["mf", "--jobs", "2"])
+    assert cli.main() == 0
+    (scripts / "a" / "done.tf.py").write_text("import sys\nsys.exit(0)")
+    (scripts / "b" / "done.tf.py").write_text("raise SystemExit")
+    assert cli.main() == 0
+    (scripts / "c" / "exit.tf.py").write_text("import sys\nsys.exit(2)")
+    assert cli.main() == 1
+    (scripts / "c" / "exit.tf.py").unlink()
+    (scripts / "a" / "broken.tf.py").write_text("raise ValueError('broken')")
+    assert cli.main() == 1
+
+
+def test_build_cache(scripts):
+    from metaform import cli
+
+    def cached(**kwargs):
+        results = cli.find_and_generate_metaf_files(".", **kwargs)
+        return {result.path for result in results if result.cached}
+
+    assert cached() == set()
+    assert cached() == {"a/a.tf.py", "b/b.tf.py", "b/leak.tf.py", "c/c.tf.py"}
+    (scripts / "b.tf").write_text("edited")
+    (scripts / "c" / "c.tf.py").write_text(
+        _SCRIPT.format(name="c") + "\nprint('changed')"
+    )
+    assert cached() == {"a/a.tf.py", "b/leak.tf.py"}
+    assert (scripts / "b.tf").read_text().startswith("terraform {")
+    assert cached(force=True) == set()
+    assert cached(jobs=2) == {"a/a.tf.py", "b/b.tf.py", "b/leak.tf.py", "c/c.tf.py"}
+
+
+def test_watch_metaf_files(scripts, capsys):
+    import threading
+    import time
+    from metaform import cli
+
+    cli.find_and_generate_metaf_files(".")
+    watcher = threading.Thread(
+        target=cli.watch_metaf_files,
+        kwargs={"interval": 0.01, "debounce": 0.05, "max_cycles": 1},
+    )
+    watcher.start()
+    time.sleep(0.05)
+    capsys.readouterr()
+    (scripts / "a" / "a.tf.py").write_text(_SCRIPT.format(name="z"))
+    watcher.join(timeout=5)
+    assert not watcher.is_alive()
+    out = capsys.readouterr().out
+    assert out.startswith("In file a/a.tf.py\nbuilt z\n  ok in ")
+    assert "Generated 1 of 1 scripts" in out
+    assert (scripts / "z.tf").exists()
+
+
+def test_stats(scripts, capsys):
+    from metaform import cli
+
+    results = cli.find_and_generate_metaf_files(".", stats=True)
+    assert [len(result.stats) for result in results] == [1, 1, 0, 1]
+    assert results[0].stats[0]["blocks"] == {"resource": 1}
+    assert "  a: 1 blocks, 1 layers (widest 1), " in capsys.readouterr().out
+
+
+def test_script_cache_and_lazy_startup(scripts, monkeypatch):
+    import os
+    import subprocess
+    import sys
+    from metaform import cache, cli
+
+    monkeypatch.setattr("sys.dont_write_bytecode", False)
+    script = os.path.join("a", "a.tf.py")
+    cache_path = cache.script_cache_path(script)
+    assert cache_path.startswith(os.path.join("a", "__pycache__", "a.tf.py."))
+    code = cache.compile_script(script)
+    assert os.path.exists(cache_path)
+    assert cache.compile_script(script) is not code
+    assert cache.compile_script(script).co_consts == code.co_consts
+    (scripts / "a" / "a.tf.py").write_text(_SCRIPT.format(name="edited"))
+    assert "edited" in cache.compile_script(script).co_consts
+    assert cli.run_metaf_file(script).output == "built edited\n"
+
+    modules = subprocess.run(
+        [sys.executable, "-c", "import sys, metaform.cli; print(*sys.modules)"],
+        capture_output=True,
+        text=True,
+        env={
+            **os.environ,
+            "PYTHONPATH": os.path.dirname(os.path.dirname(cli.__file__)),
+        },
+        check=True,
+    ).stdout.split()
+    for module in ("metaform.compose", "metaform.bench", "hashlib", "concurrent"):
+        assert module not in modules
@@ -148,3 +148,828 @@ def test_resolve_dependencies(compose):
     missing_deps = {"a": {"b"}, "b": {"c", "d"}, "c": set(), "e": {"f"}, "f": {"d"}}
     with pytest.raises(compose.DependencyError):
         _ = compose.resolve_dependencies(missing_deps)
+
+
+def test_dependencies_without_rendering(tf, monkeypatch):
+    from metaform.blocks import Block
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("dependencies should be found without rendering")
+
+    host = tf.data("aws_ssm_parameter", "host", name="host")
+    token = tf.data("aws_ssm_parameter", "token", name="token")
+    bucket = tf.resource("aws_s3_bucket", "bucket", bucket="bucket")
+    monkeypatch.setattr(Block, "_format_props", _fail)
+    libs = tf.property("library", location=bucket["arn"])
+    job = tf.resource(
+        "databricks_job",
+        "job",
+        library=libs,
+        tags={"host": host["value"], "nested": {"token": token["value"]}},
+        args=[bucket["id"], "static"],
+    )
+    assert libs.dependencies == {bucket}
+    assert job.dependencies == {host, token, bucket}
+
+
+def test_resolve_dependencies_reports_cycle(compose):
+    circular_deps = {
+        "a": {"b"},
+        "b": {"c", "d"},
+        "c": set(),
+        "d": {"e"},
+        "e": {"f"},
+        "f": {"d"},
+    }
+    with pytest.raises(compose.DependencyError, match="d -> e -> f -> d"):
+        _ = compose.resolve_dependencies(circular_deps)
+
+    with pytest.raises(compose.DependencyError, match="f -> f"):
+        _ = compose.resolve_dependencies({"a": {"f"}, "f": {"f"}})
+
+    chain = {str(i): {str(i - 1)} if i else set() for i in range(500)}
+    assert compose.resolve_dependencies(chain) == [{str(i)} for i in range(500)]
+    assert compose.resolve_dependencies({"a": {"b"}, "c": set()}, {"b"}) == [{"a", "c"}]
+
+
+def test_collect_order(tf):
+    out = tf.output("bucket_arn", value="arn")
+    second = tf.resource("aws_s3_bucket", "second", bucket="second")
+    first = tf.resource("aws_s3_bucket", "first", bucket="first")
+    var = tf.variable("region", default="us-east-1")
+    tf.provider.add("aws", source="hashicorp/aws", region=var["value"])
+    policy = tf.resource("aws_s3_bucket_policy", "policy", bucket=second["id"])
+    key = tf.data("aws_kms_key", "key", key_id=var["value"])
+    blocks = tf.iter_collect()
+    assert next(blocks)._write().startswith("terraform {")
+    assert [str(block) for block in blocks] == [
+        "var.region",
+        "resource.aws_s3_bucket.second",
+        "resource.aws_s3_bucket.first",
+        "output.bucket_arn",
+        "provider.aws",
+        "data.aws_kms_key.key",
+        "resource.aws_s3_bucket_policy.policy",
+    ]
+    assert tf.collect()[1:] == [
+        var,
+        second,
+        first,
+        out,
+        tf.registry["provider.aws"],
+        key,
+        policy,
+    ]
+
+
+def test_build_stream(tf, tmp_path, monkeypatch):
+    import io
+
+    host = tf.data("aws_ssm_parameter", "host", name="host")
+    tf.resource("aws_s3_bucket", "bucket", bucket=host["value"])
+    expected = tf._write()
+    assert "".join(tf.iter_write()) == expected
+
+    text = io.StringIO()
+    assert tf.build(stream=text)[:4] == ([], [], [], True)
+    assert text.getvalue() == expected
+
+    binary = io.BytesIO()
+    tf.build(stream=binary)
+    assert binary.getvalue() == expected.encode()
+
+    with open(tmp_path / "raw.tf", "wb", buffering=0) as raw:
+        tf.build(stream=raw)
+    assert (tmp_path / "raw.tf").read_text() == expected
+
+    monkeypatch.chdir(tmp_path)
+    tf.build()
+    assert (tmp_path / "main.tf").read_text() == expected
+
+
+def test_build_split_out(tmp_path, monkeypatch):
+    import os
+    from metaform.blocks import BlockError
+    from metaform.compose import MetaFormer
+
+    monkeypatch.chdir(tmp_path)
+    tf = MetaFormer(split_out=True)
+    tf.provider.add("aws", source="hashicorp/aws", region="us-east-1")
+    region = tf.variable("region", default="us-east-1")
+    key = tf.data("aws_kms_key", "key", key_id=region["value"])
+    bucket = tf.resource("aws_s3_bucket", "bucket", kms=key["arn"])
+    tf.output("bucket_arn", value=bucket["arn"])
+    tf.build()
+    assert sorted(path.name for path in tmp_path.glob("*.tf")) == [
+        "data.tf",
+        "outputs.tf",
+        "providers.tf",
+        "resources.tf",
+        "variables.tf",
+    ]
+    assert (tmp_path / "providers.tf").read_text().startswith("terraform {")
+    assert (tmp_path / "data.tf").read_text() == key._write()
+    umask = os.umask(0o027)
+    os.umask(umask)
+    assert (tmp_path / "resources.tf").stat().st_mode & 0o777 == 0o666 & ~umask
+    (tmp_path / "resources.tf").chmod(0o600)
+
+    before = {path.name: path.stat().st_ino for path in tmp_path.iterdir()}
+    bucket.properties["bucket"] = "renamed"
+    tf.build()
+    after = {path.name: path.stat().st_ino for path in tmp_path.iterdir()}
+    assert {name for name in after if after[name] != before[name]} == {
+        "resources.tf",
+        ".main.metaform-hashes",
+    }
+    assert (tmp_path / "resources.tf").stat().st_mode & 0o777 == 0o600
+
+    tf.split_out = lambda block: "vars" if block._group == "variable" else "main"
+    tf.build()
+    assert sorted(path.name for path in tmp_path.glob("*.tf")) == ["main.tf", "vars.tf"]
+    assert (tmp_path / "vars.tf").read_text() == region._write()
+    assert (tmp_path / "main.tf").read_text().count("\n\n") == 4
+
+    (tmp_path / "out").mkdir()
+    stack = MetaFormer("out/stack", split_out=True)
+    stack.resource("aws_s3_bucket", "other")
+    assert stack.build().paths == ("out/providers.tf", "out/resources.tf")
+    assert (tmp_path / "out" / ".stack.metaform-hashes").exists()
+    assert (tmp_path / "vars.tf").exists() and (tmp_path / "main.tf").exists()
+    clash = MetaFormer("out/clash", split_out=True)
+    with pytest.raises(BlockError, match="out/providers.tf"):
+        clash.build()
+
+
+def test_render_cache(tf, monkeypatch):
+    import copy
+    import pickle
+    from metaform.blocks import Block
+
+    libs = tf.property("library", location="s3://bucket")
+    settings = tf.property("settings", timeout=10, library=libs)
+    jobs = [tf.resource("databricks_job", f"job_{i}", settings=settings) for i in "ab"]
+    assert jobs[0]._write() == (
+        'resource "databricks_job" "job_a" {\n  settings {\n    timeout = 10\n'
+        '    library {\n      location = "s3://bucket"\n    }\n  }\n}'
+    )
+
+    renders = []
+    format_props = Block._format_props
+    monkeypatch.setattr(
+        Block, "_format_props", lambda b: renders.append(str(b)) or format_props(b)
+    )
+    jobs[1]._write()
+    jobs[0]._write(pad=1)
+    assert renders == ["resource.databricks_job.job_b", "resource.databricks_job.job_a"]
+    assert jobs[0]._rendered is None and settings._rendered is not None
+
+    renders.clear()
+    libs.properties["location"] = "s3://other"
+    assert 's3://other"' in jobs[0]._write() and 's3://other"' in jobs[1]._write()
+    assert renders == [
+        "resource.databricks_job.job_a",
+        "settings",
+        "library",
+        "resource.databricks_job.job_b",
+    ]
+
+    key = tf.data("aws_kms_key", "key", key_id="alias/key")
+    libs.properties.update(key=key["arn"])
+    assert jobs[0].dependencies == {key}
+
+    for clone in (copy.deepcopy(jobs[0]), pickle.loads(pickle.dumps(jobs[0]))):
+        assert clone._write() == jobs[0]._write() and clone.dependencies == {key}
+        library = clone.properties["settings"].properties["library"]
+        library.properties["location"] = "s3://copy"
+        assert 's3://copy"' in clone._write() and 's3://copy"' not in jobs[0]._write()
+
+    libs.properties["tags"] = {"a": "b"}
+    assert 'a = "b"' in jobs[0]._write()
+    libs.properties["tags"]["c"] = "d"  # in place, without invalidating anything
+    assert 'c = "d"' in jobs[0]._write() and 'c = "d"' in jobs[1]._write()
+    assert libs._rendered is None and settings._rendered is None
+
+
+def test_block_slots_and_identity(tf):
+    from metaform.blocks import Block, _NO_DEPENDENCIES
+
+    bucket = tf.resource("aws_s3_bucket", "bucket", bucket="bucket")
+    arn = bucket["arn"]
+    assert not hasattr(bucket, "__dict__") and not hasattr(arn, "__dict__")
+    assert str(arn) == "resource.aws_s3_bucket.bucket.arn"
+    twin = Block("resource", "aws_s3_bucket", "bucket")
+    assert twin == bucket and hash(twin) == hash(bucket) and twin is not bucket
+    assert twin != Block("resource", "aws_s3_bucket", "other")
+    assert str(twin) is str(bucket)
+    assert bucket.dependencies is twin.dependencies is _NO_DEPENDENCIES
+
+
+def test_build_stats(tf, tmp_path, monkeypatch):
+    import io
+    from metaform.compose import build_session
+
+    monkeypatch.chdir(tmp_path)
+    region = tf.variable("region", default="us-east-1")
+    for name in ["a", "b"]:
+        tf.resource("aws_s3_bucket", name, region=region["value"])
+    assert tf.build(stream=io.StringIO()).stats is None
+
+    exported = []
+    with build_session(stats=True, on_build=exported.append) as session:
+        stats = tf.build().stats
+        assert exported == [stats]
+        assert tf.build(stats=False).stats is None
+    assert exported == [stats]
+    assert [result.stats for result in session.results] == [stats, None]
+    assert session.paths == ["main.tf", "main.tf"]
+    assert tf.build().stats is None
+    summary = stats.as_dict()
+    assert summary["blocks"] == {"variable": 1, "resource": 2}
+    assert (summary["layers"], summary["widest_layer"]) == (2, 2)
+    assert summary["files"] == {"main.tf": len(tf._write().encode())}
+    assert set(summary["phases"]) == {
+        "build",
+        "dependencies",
+        "sort",
+        "hash",
+        "render",
+        "write",
+    }
+    assert stats.summary().startswith("main: 3 blocks, 2 layers (widest 2), ")
+
+
+def test_bulk(tf):
+    from metaform.blocks import BlockError
+
+    key = tf.data("aws_kms_key", "key", key_id="alias/key")
+    rows = [
+        {"id": "db_host", "name": "/db/host", "key_id": key["id"]},
+        {"id": "db_port", "name": "/db/port", "key_id": key["id"]},
+    ]
+    host, port = tf.resource.bulk("aws_ssm_parameter", rows)
+    assert rows[0]["id"] == "db_host"
+    assert str(port) == "resource.aws_ssm_parameter.db_port"
+    assert tf.resource["resource.aws_ssm_parameter.db_host"] is host
+    assert host.dependencies == {key}
+    assert port._write() == (
+        'resource "aws_ssm_parameter" "db_port" {\n  name   = "/db/port"\n'
+        "  key_id = data.aws_kms_key.key.id\n}"
+    )
+
+    with pytest.raises(BlockError, match="db_host"):
+        tf.resource.bulk("aws_ssm_parameter", {"id": ["db_user", "db_host"]})
+    assert "resource.aws_ssm_parameter.db_user" not in tf.registry
+    with pytest.raises(BlockError, match="db_user"):
+        tf.resource.bulk("aws_ssm_parameter", {"id": ["db_user", "db_user"]})
+    with pytest.raises(BlockError, match="same length"):
+        tf.resource.bulk("aws_ssm_parameter", {"id": ["c", "d"], "value": [1]})
+    for for_each in (None, "missing"):
+        with pytest.raises(BlockError, match="has no id"):
+            tf.resource.bulk("aws_ssm_parameter", [{"value": 1}], for_each=for_each)
+    assert "resource.aws_ssm_parameter.c" not in tf.registry
+
+    params = tf.resource.bulk(
+        "aws_ssm_parameter",
+        {"name": ["/app/a", "/app/b"], "value": ["a", 1], "id": ["a", "b"]},
+        for_each="app",
+    )
+    assert str(params) == "resource.aws_ssm_parameter.app"
+    assert params._write() == (
+        'resource "aws_ssm_parameter" "app" {\n'
+        "  name     = each.value.name\n"
+        "  value    = each.value.value\n"
+        "  for_each = {\n"
+        '    a = { name = "/app/a", value = "a" }\n'
+        '    b = { name = "/app/b", value = 1 }\n'
+        "  }\n}"
+    )
+    keyed = tf.resource.bulk("aws_ssm_parameter", rows, for_each="keyed")
+    assert keyed.dependencies == {key} and rows[1]["id"] == "db_port"
+    assert tf.registry.levels[str(keyed)] == 1
+
+
+def test_build_json(tf, tmp_path, monkeypatch):
+    import json
+
+    monkeypatch.chdir(tmp_path)
+    tf.provider.add("aws", source="hashicorp/aws", version="~> 5.0", region="eu-west-1")
+    key = tf.data("aws_kms_key", "key", key_id="alias/key")
+    libs = tf.property("library", location="s3://bucket")
+    tf.resource(
+        "databricks_job",
+        "job",
+        library=libs,
+        retries=3,
+        enabled=True,
+        tags={"key": key["arn"]},
+        args=("a", 1),
+    )
+    tf.build(format="json")
+    assert json.loads((tmp_path / "main.tf.json").read_text()) == {
+        "terraform": {
+            "required_providers": {
+                "aws": {"source": "hashicorp/aws", "version": "~> 5.0"}
+            }
+        },
+        "provider": {"aws": {"region": "eu-west-1"}},
+        "data": {"aws_kms_key": {"key": {"key_id": "alias/key"}}},
+        "resource": {
+            "databricks_job": {
+                "job": {
+                    "library": {"location": "s3://bucket"},
+                    "retries": 3,
+                    "enabled": True,
+                    "tags": {"key": "${data.aws_kms_key.key.arn}"},
+                    "args": ["a", 1],
+                }
+            }
+        },
+    }
+    assert (
+        "".join(tf.iter_write(format="json")) == (tmp_path / "main.tf.json").read_text()
+    )
+    with pytest.raises(ValueError):
+        tf.build(format="yaml")
+
+    tf.split_out = True
+    tf.build(format="json")
+    assert json.loads((tmp_path / "data.tf.json").read_text()) == {
+        "data": {"aws_kms_key": {"key": {"key_id": "alias/key"}}}
+    }
+
+
+def test_targeted_collect(tf, tmp_path, monkeypatch):
+    from metaform.blocks import BlockError
+
+    region = tf.variable("region", default="us-east-1")
+    tf.provider.add("aws", source="hashicorp/aws", region=region["value"])
+    key = tf.data("aws_kms_key", "key", key_id="alias/key")
+    bucket = tf.resource("aws_s3_bucket", "bucket", kms=key["arn"])
+    policy = tf.resource("aws_s3_bucket_policy", "policy", bucket=bucket["id"])
+    tf.resource("aws_sqs_queue", "queue", name="queue")
+    tf.output("policy", value=policy["id"])
+
+    assert [str(block) for block in tf.collect(targets=[policy])[1:]] == [
+        "var.region",
+        "data.aws_kms_key.key",
+        "provider.aws",
+        "resource.aws_s3_bucket.bucket",
+        "resource.aws_s3_bucket_policy.policy",
+    ]
+    assert tf.registry.dependents_of(["data.aws_kms_key.key"]) == [
+        "data.aws_kms_key.key",
+        "resource.aws_s3_bucket.bucket",
+        "resource.aws_s3_bucket_policy.policy",
+        "output.policy",
+    ]
+    with pytest.raises(BlockError):
+        tf.collect(targets=["resource.aws_s3_bucket.missing"])
+
+    monkeypatch.chdir(tmp_path)
+    tf.build(targets=["resource.aws_s3_bucket.bucket"])
+    written = (tmp_path / "main.tf").read_text()
+    assert 'resource "aws_s3_bucket" "bucket"' in written
+    assert "aws_s3_bucket_policy" not in written and "aws_sqs_queue" not in written
+
+
+def test_incremental_build(tf, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    region = tf.variable("region", default="us-east-1")
+    a = tf.resource("aws_s3_bucket", "a", region=region["value"])
+    tf.resource("aws_s3_bucket", "b", region=region["value"])
+    first = tf.build()
+    assert first.written and "resource.aws_s3_bucket.a" in first.added
+    before = (tmp_path / "main.tf").stat()
+
+    unchanged = tf.build()
+    assert unchanged[:4] == ([], [], [], False)
+    after = (tmp_path / "main.tf").stat()
+    assert (after.st_ino, after.st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
+
+    a.properties["acl"] = "private"
+    tf.resource("aws_s3_bucket", "c", region=region["value"])
+    del tf.registry["resource.aws_s3_bucket.b"]
+    changed = tf.build()
+    assert changed[:4] == (
+        ["resource.aws_s3_bucket.c"],
+        ["resource.aws_s3_bucket.b"],
+        ["resource.aws_s3_bucket.a"],
+        True,
+    )
+    assert (tmp_path / "main.tf").read_text() == tf._write()
+
+    (tmp_path / "main.tf").write_text("edited by hand")
+    assert tf.build().written and (tmp_path / "main.tf").read_text() == tf._write()
+
+
+def test_registry_snapshot(tf, tmp_path):
+    from metaform.compose import MetaFormer
+    from metaform.snapshot import SnapshotError, load_registry, save_registry
+
+    tf.provider.add("aws", region="us-east-1")
+    region = tf.variable("region", default="us-east-1")
+    key = tf.data("aws_kms_key", "key", key_id=region["value"])
+    settings = tf.property("settings", "a", enabled=True, kms=key["arn"])
+    tf.resource(
+        "aws_s3_bucket",
+        "a",
+        tags={"team": "data", "region": region["value"]},
+        zones=("a", "b"),
+        versions=[1.5, False],
+        settings=settings,
+    )
+    tf.resource("aws_s3_bucket", "b", region=region["value"])
+    save_registry(tf.registry, tmp_path / "stack.mfsnap")
+
+    registry = load_registry(tmp_path / "stack.mfsnap")
+    assert list(registry) == list(tf.registry)
+    downstream = MetaFormer(registry=registry)
+    assert list(downstream.iter_write())[1:] == list(tf.iter_write())[1:]
+    assert registry["resource.aws_s3_bucket.a"].dependencies == {region, key}
+
+    downstream.output("arn", value=registry["resource.aws_s3_bucket.a"]["arn"])
+    assert str(downstream.collect()[-1]) == "output.arn"
+    registry["settings.a"].properties["mode"] = "strict"
+    assert "strict" in registry["resource.aws_s3_bucket.a"]._write()
+
+    targeted = load_registry(tmp_path / "stack.mfsnap", ["resource.aws_s3_bucket.b"])
+    assert list(targeted) == ["var.region", "resource.aws_s3_bucket.b"]
+
+    (tmp_path / "bad.mfsnap").write_bytes(b"not a snapshot")
+    with pytest.raises(SnapshotError):
+        load_registry(tmp_path / "bad.mfsnap")
+
+
+def test_map_and_list_rendering(tf):
+    bucket = tf.resource(
+        "aws_s3_bucket",
+        "bucket",
+        tags={"team": "data", "env": "prod"},
+        zones=["a", "b"],
+        rules={"expire": {"days": 30, "prefixes": ("logs/", "tmp/", "a/", "b/")}},
+        empty={},
+    )
+    assert bucket._write() == (
+        'resource "aws_s3_bucket" "bucket" {\n'
+        '  tags  = tomap({ team = "data", env = "prod" })\n'
+        '  zones = tolist(["a", "b"])\n'
+        "  rules = tomap({\n"
+        "    expire = tomap({\n"
+        "      days     = 30\n"
+        "      prefixes = tolist([\n"
+        '        "logs/",\n'
+        '        "tmp/",\n'
+        '        "a/",\n'
+        '        "b/",\n'
+        "      ])\n"
+        "    })\n"
+        "  })\n"
+        "  empty = tomap({})\n"
+        "}"
+    )
+    tags = tf.variable("tags", tomap=False, default={"a": "1", "b": "2"})
+    assert tags._write(pad=1).splitlines()[1] == '    default = { a = "1", b = "2" }'
+
+
+def test_value_serialization(tf):
+    import io
+    import json
+    import pickle
+    from metaform.blocks import Interpolated
+
+    class Tier(str):
+        pass
+
+    job = tf.resource(
+        "databricks_job",
+        "job",
+        enabled=False,
+        timeout=1.5,
+        retries=3,
+        parent=None,
+        tier=Tier("gold"),
+        name='say "hi" to ${user}\\',
+        script="set -e\n  echo ok\n",
+        query="SELECT 1\nFROM t",
+        tags={"kubernetes.io/role": "worker"},
+    )
+    assert job._write().splitlines()[1:] == [
+        "  enabled = false",
+        "  timeout = 1.5",
+        "  retries = 3",
+        "  parent  = null",
+        '  tier    = "gold"',
+        '  name    = "say \\"hi\\" to $${user}\\\\"',
+        "  script  = <<-EOT",
+        "  set -e",
+        "    echo ok",
+        "  EOT",
+        "  query   = chomp(<<-EOT",
+        "  SELECT 1",
+        "  FROM t",
+        "  EOT",
+        "  )",
+        '  tags    = tomap({ "kubernetes.io/role" = "worker" })',
+        "}",
+    ]
+    stream = io.StringIO()
+    tf.build(stream=stream, format="json")
+    body = json.loads(stream.getvalue())["resource"]["databricks_job"]["job"]
+    assert body["name"] == 'say "hi" to $${user}\\' and body["enabled"] is False
+
+    bucket = tf.resource(
+        "aws_s3_bucket",
+        "env",
+        bucket=Interpolated("${var.env}-bucket"),
+        names=[Interpolated('%{ if a }"a"%{ endif }')],
+    )
+    assert bucket._write().splitlines()[1:3] == [
+        '  bucket = "${var.env}-bucket"',
+        '  names  = tolist(["%{ if a }\\"a\\"%{ endif }"])',
+    ]
+    assert pickle.loads(pickle.dumps(bucket))._write() == bucket._write()
+    stream = io.StringIO()
+    tf.build(stream=stream, format="json", targets=[bucket])
+    body = json.loads(stream.getvalue())["resource"]["aws_s3_bucket"]["env"]
+    assert body["bucket"] == "${var.env}-bucket"
+
+
+def test_template(tf):
+    from metaform.blocks import BlockError
+    from metaform.compose import MetaFormer
+
+    def bucket(tf, name, days):
+        b = tf.resource("aws_s3_bucket", name, bucket=f"{name}-bucket", tags={"x": 1})
+        rule = tf.property("rule", name, days=days, prefix=[f"{name}/", "tmp/"])
+        tf.resource("aws_s3_bucket_lifecycle", name, bucket=b["id"], rule=rule)
+        tf.output(f"{name}_arn", value=b["arn"], region=region["value"])
+        return {"bucket": b}
+
+    region = tf.variable("region", default="us-east-1")
+    stamp = tf.template(bucket)
+    logs = stamp(name="logs", days=30)["bucket"]
+    stamp(name="data", days=7)
+    direct = MetaFormer()
+    region = direct.variable("region", default="us-east-1")
+    for name, days in [("logs", 30), ("data", 7)]:
+        bucket(direct, name, days)
+    assert tf._write() == direct._write()
+    assert logs is tf.registry["resource.aws_s3_bucket.logs"]
+    assert tf.resource["resource.aws_s3_bucket_lifecycle.data"].dependencies == {
+        tf.registry["resource.aws_s3_bucket.data"]
+    }
+    assert tf.registry["output.data_arn"].dependencies == {
+        tf.registry["resource.aws_s3_bucket.data"],
+        tf.registry["var.region"],
+    }
+
+    tf.registry["rule.logs"].properties["days"] = 90
+    assert (
+        "days   = 90" in tf.registry["resource.aws_s3_bucket_lifecycle.logs"]._write()
+    )
+    with pytest.raises(BlockError):
+        stamp(name="logs", days=1)
+    with pytest.raises(TypeError):
+        stamp(name="other")
+
+    def subnet(tf, name, vpc):
+        rule = tf.property("rule", name, vpc=vpc)
+        return tf.resource("aws_subnet", name, vpc_id=vpc, rule=rule, zone=region)
+
+    subnets = tf.template(subnet)
+    late = subnets(name="b", vpc=tf.resource("aws_vpc", "main")["id"])
+    assert late.dependencies == {tf.registry["resource.aws_vpc.main"], region}
+    assert "resource.aws_subnet.b" in tf.registry.dependents["resource.aws_vpc.main"]
+    subnets(name="c", vpc="vpc-123")
+    assert tf.registry["resource.aws_subnet.c"].dependencies == {region}
+    keys = [block._key for block in tf.collect(["resource.aws_subnet.b"])]
+    assert keys.index("resource.aws_vpc.main") < keys.index("resource.aws_subnet.b")
+
+    def branching(tf, enabled, n):
+        if enabled:
+            tf.resource("x", "on", count=n)
+
+    def arithmetic(tf, enabled, n):
+        tf.resource("x", "on", count=n + 1)
+
+    for fn in (branching, arithmetic):
+        with pytest.raises(BlockError, match="has no value while"):
+            tf.template(fn)
+
+
+def test_online_cycle_detection(tf, compose):
+    from metaform.blocks import Block
+
+    region = tf.variable("region", default="us-east-1")
+    key = tf.data("aws_kms_key", "key", key_id=region["value"])
+    bucket = tf.resource("aws_s3_bucket", "bucket", kms=key["arn"])
+    rule = tf.property("rule", "expire", days=30)
+    tf.resource("aws_s3_bucket_lifecycle", "bucket", bucket=bucket["id"], rule=rule)
+    assert tf.registry.levels["resource.aws_s3_bucket_lifecycle.bucket"] == 3
+
+    with pytest.raises(
+        compose.DependencyError,
+        match="var.region -> resource.aws_s3_bucket.bucket -> "
+        "data.aws_kms_key.key -> var.region",
+    ):
+        region.properties["default"] = bucket["region"]
+    assert region.properties == {"default": "us-east-1"} and not region.dependencies
+    with pytest.raises(compose.DependencyError, match="data.aws_kms_key.key -> "):
+        rule.properties["kms"] = key["arn"]
+        tf.registry["data.aws_kms_key.key"].properties = {"bucket": bucket["id"]}
+    assert tf.registry.levels["data.aws_kms_key.key"] == 1
+    assert tf.registry.levels["rule.expire"] == 2
+
+    later = Block("variable", "later")
+    tf.resource("aws_s3_bucket", "other", name=later["value"])
+    with pytest.raises(compose.DependencyError, match="var.later which is not"):
+        tf.collect()
+    tf.registry["var.later"] = later
+    assert str(tf.collect()[-1]) == "resource.aws_s3_bucket_lifecycle.bucket"
+    del tf.registry["var.later"]
+    assert "resource.aws_s3_bucket.other" not in tf.registry.levels
+
+
+def test_dependency_graph(tf, compose, tmp_path, monkeypatch):
+    import json
+
+    monkeypatch.chdir(tmp_path)
+    region = tf.variable("region", default="us-east-1")
+    key = tf.data("aws_kms_key", "key", key_id=region["value"])
+    bucket = tf.resource("aws_s3_bucket", "bucket", kms=key["arn"], region=region)
+    tf.resource("aws_s3_bucket_policy", "bucket", bucket=bucket["id"])
+    tf.output("bucket", value=bucket["arn"], kms=key["arn"])
+
+    graph = tf.graph()
+    assert graph.layers == [1, 1, 1, 2]
+    assert graph.critical_path == [
+        "resource.aws_s3_bucket_policy.bucket",
+        "resource.aws_s3_bucket.bucket",
+        "data.aws_kms_key.key",
+        "var.region",
+    ]
+    metrics = graph.metrics()
+    assert metrics["edges"] == 6 and metrics["average_parallelism"] == 1.25
+    assert metrics["fan_in"][:2] == [["var.region", 2], ["data.aws_kms_key.key", 2]]
+    assert metrics["fan_out"][0] == ["resource.aws_s3_bucket.bucket", 2]
+    assert tf.graph(["data.aws_kms_key.key"]).layers == [1, 1]
+
+    dot = graph.to_dot()
+    assert dot.startswith('digraph "main" {')
+    assert '"output.bucket" -> "resource.aws_s3_bucket.bucket";' in dot
+    assert '"data.aws_kms_key.key" -> "var.region" [color=red];' in dot
+    assert json.loads(graph.to_json())["nodes"][0] == {
+        "id": "var.region",
+        "group": "variable",
+        "layer": 0,
+        "fan_in": 2,
+        "fan_out": 0,
+    }
+
+    assert tf.build(graph="dot").written
+    assert (tmp_path / "main.graph.dot").read_text() == dot
+    with compose.build_session(graph="dot"):
+        assert not tf.build().written
+    (tmp_path / "main.graph.dot").unlink()
+    assert tf.build(graph="dot").written and (tmp_path / "main.graph.dot").exists()
+
+
+def test_build_many(compose, tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from functools import partial
+
+    monkeypatch.chdir(tmp_path)
+    shared = compose.Registry()
+    stacks = [
+        compose.MetaFormer(f"stack{index}", registry=shared, namespace=f"s{index}")
+        for index in range(4)
+    ]
+    assert stacks[1].registry is shared.namespace("s1") is not shared
+
+    def define(tf):
+        region = tf.variable("region", default=tf.name)
+        for index in range(50):
+            tf.resource("aws_s3_bucket", f"b{index}", region=region["value"])
+
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(define, stacks))
+
+    def register(_):
+        try:
+            return stacks[0].variable.bulk("shared", [{"id": "x"}])
+        except compose.BlockError:
+            return None
+
+    with ThreadPoolExecutor(8) as pool:
+        assert sum(map(bool, pool.map(register, range(8)))) == 1
+    assert all(len(tf.registry.levels) == 51 for tf in stacks[1:])
+
+    results = compose.build_many(stacks, workers=4)
+    assert [len(result.added) for result in results] == [53, 52, 52, 52]
+    assert 'default = "stack3"' in (tmp_path / "stack3.tf").read_text()
+
+    exported = []
+    with compose.build_session(stats=True, on_build=exported.append) as session:
+        results = compose.build_many(
+            [partial(compose.MetaFormer, "empty")], workers=1, processes=True
+        )
+        compose.build_many(stacks[:2], workers=2)
+    assert results[0].written and (tmp_path / "empty.tf").exists()
+    assert results[0].paths == ("empty.tf",)
+    assert sorted(session.paths) == ["empty.tf", "stack0.tf", "stack1.tf"]
+    assert all(result.stats is not None for result in session.results)
+    assert len(exported) == 3
+    with pytest.raises(TypeError):
+        compose.build_many(stacks, processes=True)
+
+
+def test_sqlite_registry(compose, tmp_path, monkeypatch):
+    from metaform.blocks import Block
+    from metaform.storage import SQLiteRegistry
+    import gc
+    import sqlite3
+
+    monkeypatch.chdir(tmp_path)
+
+    def define(tf):
+        region = tf.variable("region", default="us-east-1")
+        rule = tf.property("lifecycle_rule", "expire", days=30)
+        key = tf.data("aws_kms_key", "key", key_id=region["value"])
+        for index in range(6):
+            bucket = tf.resource(
+                "aws_s3_bucket",
+                f"b{index}",
+                kms=key["arn"],
+                rule=rule,
+                versioning=Block("property", "versioning", enabled=True),
+                tags={"index": str(index), "values": [1, 2.5, None, True]},
+                policy="line\n${literal}",
+            )
+            tf.output(f"b{index}", value=bucket["arn"])
+        tf.resource.bulk(
+            "aws_ssm_parameter", [{"id": "a", "value": 1}, {"id": "b", "value": 2}]
+        )
+        rule.properties["days"] = 60
+        tf.resource["resource.aws_s3_bucket.b0"].properties["late"] = region["value"]
+
+    memory = compose.MetaFormer("memory")
+    define(memory)
+    registry = SQLiteRegistry(str(tmp_path / "registry.db"), cache_size=2)
+    stored = compose.MetaFormer("stored", registry=registry)
+    define(stored)
+    assert len(registry.resident) == 2
+    assert sum(isinstance(v, Block) for v in dict.values(registry)) <= 2
+    for format in ("hcl", "json"):
+        assert list(stored.iter_write(format=format)) == list(
+            memory.iter_write(format=format)
+        )
+    chunks = stored.iter_write(format="json")
+    next(chunks)  # the document is grouped, blocks are only written from here on
+    gc.collect()
+    assert len(registry.live) < len(registry) // 2  # only those resident ones use
+    chunks.close()
+    memory.build()
+    stored.build()
+    assert (tmp_path / "stored.tf").read_text() == (tmp_path / "memory.tf").read_text()
+    with sqlite3.connect(str(tmp_path / "registry.db")) as connection:
+        (count,) = connection.execute("SELECT COUNT(*) FROM blocks").fetchone()
+    assert count == len(registry)  # committed by the build, without close()
+    assert stored.graph().layers == memory.graph().layers
+
+    del registry["output.b5"]
+    registry.close()
+    with SQLiteRegistry(str(tmp_path / "registry.db"), cache_size=2) as reopened:
+        assert "output.b5" not in reopened and len(reopened) == len(memory.registry) - 1
+        assert reopened.levels == {
+            k: v for k, v in memory.registry.levels.items() if k != "output.b5"
+        }
+        assert reopened["resource.aws_s3_bucket.b3"]._write() == (
+            memory.registry["resource.aws_s3_bucket.b3"]._write()
+        )
+        with pytest.raises(compose.DependencyError, match="circular dependency"):
+            reopened["var.region"].properties["default"] = reopened[
+                "resource.aws_s3_bucket.b0"
+            ]["id"]
+
+    def share(tf):
+        shared = Block("property", "versioning", enabled=True)
+        for index in range(5):
+            tf.resource("aws_s3_bucket", f"b{index}", versioning=shared)
+        gc.collect()  # stored parents are paged out and gone
+        shared.properties["enabled"] = False
+        shared.properties["kms"] = tf.data("aws_kms_key", "key")["arn"]
+        gc.collect()
+        return tf._write(), tf.graph().layers
+
+    shared_path = str(tmp_path / "shared.db")
+    with SQLiteRegistry(shared_path, cache_size=1) as registry:
+        assert share(compose.MetaFormer("shared", registry=registry)) == share(
+            compose.MetaFormer("shared_memory")
+        )
+    with SQLiteRegistry(shared_path, cache_size=1) as reopened:
+        bucket = reopened["resource.aws_s3_bucket.b1"]
+        assert "enabled = false" in bucket._write()
+        assert bucket.properties["versioning"] is (
+            reopened["resource.aws_s3_bucket.b4"].properties["versioning"]
+        )